@@ -0,0 +1,175 @@
+"""
+benchmark.py
+Some benchmark scenes, used to measure the cost of the generation code
+    * memory: peak memory of generating each scene with the float64 & memory-lean (float32/uint8) pipelines
+    * imports: cold-start import time of the generation modules (checked against a budget, & without matplotlib)
+    * terrain: time of the midpoint displacement & spectral terrain engines, by resolution
+    * culling: number of primitives drawn with & without occlusion culling, the time it takes, and the time it saves
+      drawing the trees
+
+Usage:
+    python benchmark.py [memory] [imports] [terrain] [culling]
+"""
+
+# Standard imports
+import argparse
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# Self imports
+import config
+import landscape
+import tree
+
+# Scene size
+w, h = 1600, 900
+
+def scene_hero_tree(dtype=np.float64):
+    """A single large Type I tree, with random (dense) trunk spikes"""
+    spikes = dict(config.spikes_brown, spike_layout='random')
+    return [tree.generate_joshua_tree(w/2, 0, length=250, seed=1, spike_back_params=spikes, dtype=dtype, **config.tree_type_i)]
+
+def scene_forest(dtype=np.float64, n=40):
+    """A forest of n random trees along a terrain ridge"""
+    np.random.seed(0)
+    terrain = landscape.midpoint_displacement([0, 200], [w, 200], 1.1, 100, 10, dtype=dtype)
+    trees = [terrain]
+    for i, tree_x in enumerate(np.linspace(0, w, n)):
+        tree_y = terrain[np.argmin(np.abs(terrain[:,0]-tree_x)),1] - 50
+        trees.append(tree.generate_random_joshua_tree(tree_x, tree_y, length=100, darken=0.8, seed=i, dtype=dtype))
+    return trees
+
+def scene_sun(dtype=np.float64):
+    """The sun/moon glow image of a full size scene"""
+    plt.figure(figsize=(w/100, h/100), dpi=100)
+    landscape.draw_sun(w, h, center=[w/2, h/3], size=800, dtype=dtype)
+    img = plt.gca().images[-1].get_array()
+    plt.close()
+    return img
+
+SCENES = {
+    'hero_tree': scene_hero_tree,
+    'forest': scene_forest,
+    'sun': scene_sun
+}
+
+def measure_memory(fn, *args, **kwargs):
+    """Peak memory (bytes) allocated while calling fn (which includes the memory of its result)"""
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def memory_report(scenes=SCENES):
+    """Peak memory of each scene with the float64 & the memory-lean pipelines"""
+    rows = []
+    for name, fn in scenes.items():
+        lean_dtype = np.uint8 if name == 'sun' else np.float32
+        full = measure_memory(fn, dtype=np.float64)
+        lean = measure_memory(fn, dtype=lean_dtype)
+        rows.append((name, full, lean, np.dtype(lean_dtype).name))
+    return rows
+
+# Generation-only workers import these modules, which should be fast & not pull in matplotlib
+GENERATION_MODULES = ['colours', 'config', 'tree', 'landscape']
+IMPORT_BUDGET = 0.05 # seconds, on top of importing numpy
+
+def import_time(module, repeat=5):
+    """Best time (seconds) to import a module in a fresh interpreter (after numpy is imported)
+    Returns (time, whether matplotlib was imported too)"""
+    code = "import sys, time, numpy; t = time.perf_counter(); import {}; print(time.perf_counter() - t, 'matplotlib' in sys.modules)".format(module)
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=here, capture_output=True, text=True, check=True).stdout.split()
+        times.append(float(out[0]))
+    return min(times), out[1] == 'True'
+
+def import_report(modules=GENERATION_MODULES, budget=IMPORT_BUDGET):
+    """Import time of each module, and whether it is within budget (& doesn't import matplotlib)"""
+    rows = []
+    for module in modules:
+        t, uses_matplotlib = import_time(module)
+        rows.append((module, t, uses_matplotlib, t <= budget and not uses_matplotlib))
+    return rows
+
+def time_call(fn, *args, repeat=3, **kwargs):
+    """Best time (seconds) of calling fn"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args, **kwargs)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+def terrain_report(iterations=(8, 10, 12, 14, 16)):
+    """Time to generate a terrain of (2^n)+1 points with each engine"""
+    rows = []
+    for n in iterations:
+        args = ([0, 200], [w, 200], 1.1, 100, n)
+        rows.append((n, time_call(landscape.midpoint_displacement, *args), time_call(landscape.spectral_displacement, *args)))
+    return rows
+
+def draw_time(trees):
+    """Time (seconds) to draw some trees on a full size scene (one pixel per data unit), and render it with Agg"""
+    fig = plt.figure(figsize=(w/100, h/100), dpi=100)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_xlim(0, w)
+    ax.set_ylim(0, h)
+    t0 = time.perf_counter()
+    for g in trees:
+        tree.draw_geometry(g, ax)
+    fig.canvas.draw()
+    t = time.perf_counter() - t0
+    plt.close(fig)
+    return t
+
+def culling_report(scenes=('hero_tree', 'forest')):
+    """Number of rects & spikes in each scene's trees before & after culling, the time taken to cull them, and the
+    time to draw them without & with culling"""
+    rows = []
+    for name in scenes:
+        trees = [g for g in SCENES[name]() if isinstance(g, tree.TreeGeometry)]
+        t0 = time.perf_counter()
+        culled = [tree.cull_geometry(g) for g in trees]
+        t = time.perf_counter() - t0
+        count = lambda gs: sum(len(g.rects) + len(g.spikes) for g in gs)
+        rows.append((name, count(trees), count(culled), t, draw_time(trees), draw_time(culled)))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the benchmarks")
+    parser.add_argument('benchmarks', nargs='*', help="Benchmarks to run: memory, imports, terrain, culling (default: all)")
+    args = parser.parse_args(argv)
+    args.benchmarks = args.benchmarks or ['memory', 'imports', 'terrain', 'culling']
+    ok = True
+    if 'memory' in args.benchmarks:
+        print("{:<12} {:>12} {:>12}  {}".format('scene', 'float64 (MB)', 'lean (MB)', 'saving'))
+        for name, full, lean, lean_name in memory_report():
+            print("{:<12} {:>12.1f} {:>12.1f}  {:.0%} ({})".format(name, full/1e6, lean/1e6, 1-lean/full, lean_name))
+    if 'imports' in args.benchmarks:
+        print("{:<12} {:>12} {:>12}  {}".format('module', 'import (ms)', 'matplotlib', 'within {:.0f}ms budget'.format(IMPORT_BUDGET*1e3)))
+        for module, t, uses_matplotlib, within in import_report():
+            print("{:<12} {:>12.1f} {:>12}  {}".format(module, t*1e3, str(uses_matplotlib), within))
+            ok = ok and within
+    if 'terrain' in args.benchmarks:
+        print("{:<12} {:>14} {:>14}  {}".format('points', 'midpoint (ms)', 'spectral (ms)', 'speed-up'))
+        for n, midpoint, spectral in terrain_report():
+            print("{:<12} {:>14.1f} {:>14.1f}  {:.0f}x".format(2**n+1, midpoint*1e3, spectral*1e3, midpoint/spectral))
+    if 'culling' in args.benchmarks:
+        print("{:<12} {:>12} {:>16} {:>14}  {}".format('scene', 'primitives', 'after culling', 'cull time (s)', 'draw time (s): all / culled'))
+        for name, n, n_culled, t, t_all, t_culled in culling_report():
+            print("{:<12} {:>12} {:>16} {:>14.2f}  {:.2f} / {:.2f}".format(name, n, '{} (-{:.0%})'.format(n_culled, 1-n_culled/n), t, t_all, t_culled))
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
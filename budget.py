@@ -0,0 +1,237 @@
+"""
+budget.py
+Estimates how big trees will be before they are generated, so a scene can be kept within a budget
+    * estimate_* give the expected number of branch segments, spikes (triangles), artists (collections or patches) &
+      bytes of a tree, from its split probabilities (config.TreeParams.split_probs) & the spike density formulas
+    * plan_scene checks a scene's trees against a Budget, lowering the level of detail (the fraction of spikes kept, see
+      thin_geometry) of every tree until it fits, or raising BudgetExceeded if it can't
+    * usage counts what the generated geometry actually used, and fit_scene checks that against the Budget too
+      (lowering the level of detail further if needed) before anything is drawn
+
+Example:
+    jobs = [('joshua', dict(x1=800, y1=0, length=250, seed=1, **config.tree_type_i)), ('random', dict(seed=2))]
+    jobs, geometries, expected, actual, lod = budget.fit_scene(jobs, budget.Budget(spikes=100000))
+    print(expected, actual)
+"""
+
+# Standard imports
+import collections
+import inspect
+import math
+import numpy as np
+
+# Self imports
+import config
+import tree
+
+# Estimated or actual usage of some trees (also used as the caps of a Budget, where None is unlimited)
+Usage = collections.namedtuple('Usage', ['segments', 'spikes', 'artists', 'bytes'])
+Budget = collections.namedtuple('Budget', Usage._fields, defaults=(None,)*len(Usage._fields))
+
+# Peak memory per spike of generating, drawing & saving (Agg) a tree, measured with tracemalloc: the geometry itself
+# (81 or 30 bytes per spike) is small next to the matplotlib paths of each triangle
+BYTES_PER_SPIKE = {'float64': 950, 'float32': 800}
+BYTES_PER_SEGMENT = 2000 # a dead tree's Rectangle patch, or a rect & its share of the recursion
+
+# Spikes are kept by a golden ratio sequence (see thin_geometry)
+GOLDEN_RATIO = (np.sqrt(5) - 1) / 2
+SPIKE_ARGS = ['spike_back_params', 'spike_forward_params', 'spike_mid_params'] # in the order of draw_texture
+
+class BudgetExceeded(Exception):
+    """Raised when a scene can't fit within its budget (even at the lowest level of detail)"""
+
+def _arguments(fn, kwargs):
+    """All the arguments of a call to fn (with its defaults filled in)"""
+    args = inspect.signature(fn).bind(**kwargs)
+    args.apply_defaults()
+    return args.arguments
+
+def spikes_per_branch(spikes, length, width):
+    """Number of spikes _spike_record places on a (width x length) branch, for compiled spike parameters"""
+    if spikes.spike_layout == 'random':
+        return int((length/width) / (0.5*spikes.spike_width*spikes.spike_length) * spikes.spike_density_rnd)
+    return spikes.nx * int(math.ceil((length/(spikes.spike_length*width)) * spikes.spike_density_y))
+
+def _estimate(params, spikes, draw_texture, draw_rect, length, width, dtype):
+    """Expected usage of a tree with compiled parameters: the expected number of branches at each depth follows the
+    split probabilities, and their expected length/width ratio (which sets the number of spikes) changes by
+    length_change/width_change per depth"""
+    segments = n_spikes = artists = 0.0
+    branches, ratio = 1.0, length/width
+    for depth in range(params.depth, 0, -1):
+        split_prob = min(params.split_probs[depth], 1.0)
+        # A branch ends (with forward & mid spikes) if neither branch splits from it, or at the last depth
+        end_prob = 1.0 if depth == 1 else (1-split_prob)**2
+        n = 0.0
+        if draw_texture[0]:
+            n += spikes_per_branch(spikes[0], ratio*0.75, 1)
+        if draw_texture[1]:
+            n += end_prob * spikes_per_branch(spikes[1], ratio, 1)
+        if draw_texture[2]:
+            n += end_prob * spikes_per_branch(spikes[2], ratio*0.25, 1)
+        segments += branches
+        n_spikes += branches * n
+        # One collection per zorder (i.e. depth) for the rects, and one for the spikes
+        artists += min(branches, 1.0) * (bool(draw_rect) + (n > 0))
+        branches *= 2*split_prob
+        ratio *= params.length_change / params.width_change
+    bytes_per_spike = BYTES_PER_SPIKE['float64' if np.dtype(dtype) == np.float64 else 'float32']
+    return Usage(segments, n_spikes, artists, n_spikes*bytes_per_spike + segments*BYTES_PER_SEGMENT)
+
+def _spike_style(args):
+    """Compiled back, forward & mid spike parameters of a tree's arguments"""
+    return [config.compile_spikes(args[k]) for k in SPIKE_ARGS]
+
+def estimate_joshua_tree(**kwargs):
+    """Expected usage of generate_joshua_tree (or draw_joshua_tree) called with these arguments"""
+    args = _arguments(tree.draw_joshua_tree, kwargs)
+    params = config.compile_tree({k: args[k] for k in config.tree_param_names})
+    width = args['width'] if args['width'] is not None else args['length']*args['length_width']
+    return _estimate(params, _spike_style(args), args['draw_texture'], args['draw_rect'], args['length'], width, args['dtype'])
+
+def estimate_random_joshua_tree(**kwargs):
+    """Expected usage of generate_random_joshua_tree (or draw_random_joshua_tree) called with these arguments
+    With a seed, this is the tree type the seed picks; otherwise it is averaged over config.forest_probabilities"""
+    args = _arguments(tree.draw_random_joshua_tree, kwargs)
+    if args['seed'] is not None:
+        # The same choice as generate_random_joshua_tree, without touching the global random state
+        rnd_idx = np.random.RandomState(args['seed']).choice(len(config.compiled_forest_trees), p=config.forest_probabilities)
+        types, probabilities = [config.compiled_forest_trees[rnd_idx]], [1.0]
+    else:
+        types, probabilities = config.compiled_forest_trees, config.forest_probabilities
+    estimates = [_estimate(params, _spike_style(args), args['draw_texture'], args['draw_rect'], args['length'],
+                           args['length']*params.length_width, args['dtype']) for params in types]
+    return Usage(*np.dot(probabilities, estimates))
+
+def estimate_dead_tree(**kwargs):
+    """Expected usage of draw_dead_tree called with these arguments (one Rectangle patch per segment)"""
+    args = _arguments(tree.draw_dead_tree, kwargs)
+    split_prob = min(args['split_prob'], 1.0)
+    segments = sum((2*split_prob)**k for k in range(args['depth']))
+    return Usage(segments, 0.0, segments, segments*BYTES_PER_SEGMENT)
+
+# Kinds of trees in a scene: how to estimate & generate them
+ESTIMATORS = {
+    'joshua': estimate_joshua_tree,
+    'random': estimate_random_joshua_tree,
+    'dead': estimate_dead_tree
+}
+GENERATORS = {
+    'joshua': tree.generate_joshua_tree,
+    'random': tree.generate_random_joshua_tree
+}
+def estimate(jobs):
+    """Total expected usage of a list of (kind, kwargs) trees, where kind is one of ESTIMATORS
+    Joshua trees can have a level of detail (an lod in their kwargs, see apply_lod), which scales their spikes"""
+    total = Usage(0.0, 0.0, 0.0, 0.0)
+    for kind, kwargs in jobs:
+        kwargs = dict(kwargs)
+        lod = kwargs.pop('lod', 1.0)
+        segments, spikes, artists, nbytes = ESTIMATORS[kind](**kwargs)
+        spike_bytes = nbytes - segments*BYTES_PER_SEGMENT
+        total = Usage(*np.add(total, (segments, spikes*lod, artists, nbytes - spike_bytes*(1-lod))))
+    return total
+
+def apply_lod(jobs, lod):
+    """Trees at a level of detail (0-1]: Joshua trees get an lod in their kwargs, so they are generated as usual &
+    then thinned (see generate), while dead trees have no spikes, so are unchanged"""
+    if lod == 1:
+        return list(jobs)
+    return [(kind, dict(kwargs, lod=lod) if kind in GENERATORS else kwargs) for kind, kwargs in jobs]
+
+def thin_geometry(geometry, lod):
+    """Keep about lod (0-1] of a tree's spikes, spread evenly over every branch: spike i is kept if the fractional part
+    of i times the golden ratio is below lod, which doesn't line up with the rows & columns of the regular layout
+    Only the spikes are thinned, so the branches (& so the tree's shape) are the same at every level of detail
+    Returns a new TreeGeometry"""
+    if lod >= 1:
+        return geometry
+    keep = (np.arange(len(geometry.spikes)) * GOLDEN_RATIO) % 1 < lod
+    return geometry._replace(
+        spikes=geometry.spikes[keep],
+        spike_colours=geometry.spike_colours[keep],
+        spike_layers=geometry.spike_layers[keep],
+        spike_zorders=geometry.spike_zorders[keep])
+
+def _over(usage, budget):
+    """Fields of the usage which are over the budget"""
+    return [k for k in Usage._fields if getattr(budget, k) is not None and getattr(usage, k) > getattr(budget, k)]
+
+def _lod_target(total, budget):
+    """Factor by which the level of detail should change to bring the spikes (& bytes) of some trees within budget
+    Spikes (& their bytes) are nearly proportional to the level of detail"""
+    target = 1.0
+    if budget.spikes is not None:
+        target = min(target, budget.spikes / max(total.spikes, 1))
+    if budget.bytes is not None:
+        segment_bytes = total.segments*BYTES_PER_SEGMENT
+        target = min(target, max(budget.bytes - segment_bytes, 0) / max(total.bytes - segment_bytes, 1))
+    return target
+
+def plan_scene(jobs, budget, min_lod=0.1):
+    """Fit a list of (kind, kwargs) trees within a Budget, lowering the level of detail of all the trees together
+    (down to min_lod) if there are too many spikes or bytes
+    Returns (jobs, estimate, lod); raises BudgetExceeded if the trees don't fit, before anything is generated"""
+    if not 0 < min_lod <= 1:
+        raise ValueError("min_lod must be between 0 and 1")
+    lod = 1.0
+    total = estimate(jobs)
+    # Lowering the level of detail only removes spikes, so there's no point lowering it if the segments or artists are over
+    fixed = [k for k in _over(total, budget) if k in ('segments', 'artists')]
+    if fixed:
+        raise BudgetExceeded("Scene is over budget ({}): estimated {}, budget {}".format(', '.join(fixed), _format(total), _format(budget)))
+    # Each step aims straight for the cap, and a little lower, in case thinning doesn't keep exactly lod of the spikes
+    while _over(total, budget) and lod > min_lod:
+        lod = max(lod * _lod_target(total, budget) * 0.98, min_lod)
+        total = estimate(apply_lod(jobs, lod))
+    over = _over(total, budget)
+    if over:
+        raise BudgetExceeded("Scene is over budget ({}), even at level of detail {:.2f}: estimated {}, budget {}".format(
+            ', '.join(over), lod, _format(total), _format(budget)))
+    return apply_lod(jobs, lod), total, float(lod)
+
+def generate(kind, kwargs):
+    """Generate the geometry of one (kind, kwargs) tree (see GENERATORS), thinned to its level of detail if kwargs has
+    an lod (see apply_lod), then culled if kwargs has cull=True (at one pixel per data unit, as scenes are drawn)"""
+    kwargs = dict(kwargs)
+    lod, cull = kwargs.pop('lod', 1.0), kwargs.pop('cull', False)
+    geometry = thin_geometry(GENERATORS[kind](**kwargs), lod)
+    return tree.cull_geometry(geometry) if cull else geometry
+
+def usage(geometries):
+    """Actual usage of some generated trees (tree.TreeGeometry), as drawn by draw_geometry
+    Bytes are the peak memory per spike & segment (BYTES_PER_SPIKE) applied to the actual counts, like the estimates"""
+    total = Usage(0, 0, 0, 0)
+    for g in geometries:
+        lean = g.spikes.dtype != np.float64
+        artists = len(np.unique(g.rect_zorders)) + len(np.unique(g.spike_zorders))
+        nbytes = len(g.spikes)*BYTES_PER_SPIKE['float32' if lean else 'float64'] + len(g.segments)*BYTES_PER_SEGMENT
+        total = Usage(*np.add(total, (len(g.segments), len(g.spikes), artists, nbytes)))
+    return total
+
+def _format(usage):
+    """Short description of a Usage (or the caps of a Budget)"""
+    return ', '.join('{}={}'.format(k, int(round(v))) for k, v in usage._asdict().items() if v is not None)
+
+def fit_scene(jobs, budget, min_lod=0.1, generator=generate):
+    """Plan a list of (kind, kwargs) trees within a Budget (see plan_scene), then generate them & check their actual
+    usage against it too, before anything is drawn: the estimates are only the expected usage, so trees which come
+    out over budget are regenerated at a level of detail lowered by how far over they were
+    Dead trees are drawn without any geometry, so their expected usage stands in for their actual usage
+    Returns (jobs, geometries (None for dead trees), estimate, actual usage, lod); raises BudgetExceeded if the trees
+    don't fit (even at min_lod)"""
+    scaled, expected, lod = plan_scene(jobs, budget, min_lod)
+    while True:
+        geometries = [generator(kind, kwargs) if kind in GENERATORS else None for kind, kwargs in scaled]
+        actual = usage([g for g in geometries if g is not None])
+        actual = Usage(*np.add(actual, estimate([job for job in scaled if job[0] not in GENERATORS])))
+        over = _over(actual, budget)
+        if not over:
+            return scaled, geometries, expected, actual, lod
+        # Lowering the level of detail only removes spikes
+        if lod <= min_lod or any(k in ('segments', 'artists') for k in over):
+            raise BudgetExceeded("Scene is over budget ({}) at level of detail {:.2f}: generated {}, budget {}".format(
+                ', '.join(over), lod, _format(actual), _format(budget)))
+        lod = float(max(lod * _lod_target(actual, budget) * 0.98, min_lod))
+        scaled = apply_lod(jobs, lod)
+        expected = estimate(scaled)
@@ -2,14 +2,40 @@
 colours.py
 Contains:
     * 28 non-standard colourmaps which look nice as scene backgrounds
+      (only built, with matplotlib, the first time they are accessed through colours.cmaps)
     * Default Joshua Tree colours (trunk, spikes, leaves)
     * Some helper functions to produce colour variation & darken/lighten a given colour
 """
 
 # Standard imports
-from matplotlib.colors import LinearSegmentedColormap, ListedColormap
+import collections.abc
 import numpy as np
 
+
+class LazyColourmaps(collections.abc.Mapping):
+    """Read-only dict of colourmaps, defined by (name, colour stops) pairs
+    Each colourmap is built the first time it is accessed & then cached, so importing this module doesn't need matplotlib"""
+    def __init__(self):
+        self._specs = {}
+        self._cache = {}
+
+    def define(self, key, name, stops):
+        self._specs[key] = (name, stops)
+        self._cache.pop(key, None)
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            from matplotlib.colors import LinearSegmentedColormap
+            name, stops = self._specs[key]
+            self._cache[key] = LinearSegmentedColormap.from_list(name, stops)
+        return self._cache[key]
+
+    def __iter__(self):
+        return iter(self._specs)
+
+    def __len__(self):
+        return len(self._specs)
+
 # Custom colourmaps
 # https://matplotlib.org/gallery/images_contours_and_fields/custom_cmap.html
 
@@ -35,10 +61,10 @@ sky3 = [
     (1.00, [0.20, 0.24, 0.38])
 ]
 
-cmaps = {}
-cmaps['alto'] = LinearSegmentedColormap.from_list('sky1', sky1)
-cmaps['twilight_town'] = LinearSegmentedColormap.from_list('sky2', sky2)
-cmaps['night'] = LinearSegmentedColormap.from_list('sky2', sky3)
+cmaps = LazyColourmaps()
+cmaps.define('alto', 'sky1', sky1)
+cmaps.define('twilight_town', 'sky2', sky2)
+cmaps.define('night', 'sky2', sky3)
 
 
 # Add some interesting ones from UI gradients (https://uigradients.com)
@@ -70,10 +96,10 @@ ui_dict = {
 }
 
 for k in ui_dict:
-    cmaps[k] = LinearSegmentedColormap.from_list(k, [(0.0, ui_dict[k][0]), (1.0, ui_dict[k][1])])
+    cmaps.define(k, k, [(0.0, ui_dict[k][0]), (1.0, ui_dict[k][1])])
 
 cool_sky = [(0.0, '#2980B9'), (0.5, '#6DD5FA'), (1.0, '#FFFFFF')]
-cmaps['cool_sky'] = LinearSegmentedColormap.from_list('cool_sky', cool_sky)
+cmaps.define('cool_sky', 'cool_sky', cool_sky)
 
 # Some pre-set colours for tree features
 cols = {}
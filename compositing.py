@@ -0,0 +1,103 @@
+"""
+compositing.py
+A post-processing stage which adds depth cues to scenes rendered as separate layers
+(an alternative to darkening the colours of each distant tree, with the `darken` argument)
+    * render_layer(): render some drawing calls on their own, into a transparent RGBA buffer
+    * fog(): blend a layer toward the sky colour, by an amount depending on its depth
+    * blur(): separable Gaussian blur (depth of field), vectorised over the whole buffer
+    * composite(): blend RGBA layers back-to-front
+All buffers are (h, w, 4) float32 arrays with values between 0 & 1 (not premultiplied by alpha)
+"""
+
+# Standard imports
+import numpy as np
+
+def render_layer(draw, w=1600, h=900, dpi=100):
+    """Call draw() (which draws on the current axis, e.g. a lambda calling tree.draw_joshua_tree) on a transparent
+    (w x h) canvas, where one data unit is one pixel with (0,0) at the bottom left, and return the RGBA buffer"""
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(w/dpi, h/dpi), dpi=dpi)
+    ax = fig.add_axes([0, 0, 1, 1])
+    fig.patch.set_alpha(0)
+    ax.patch.set_alpha(0)
+    ax.axis('off')
+    draw()
+    ax.set_xlim(0, w)
+    ax.set_ylim(0, h)
+    fig.canvas.draw()
+    layer = np.asarray(fig.canvas.buffer_rgba(), dtype=np.float32) / 255
+    plt.close(fig)
+    return layer
+
+def horizon_colour(cmap):
+    """RGB colour of the bottom (horizon) of a sky colourmap, as drawn by landscape.draw_sky"""
+    return np.array(cmap(1.0)[:3], dtype=np.float32)
+
+def fog_amount(depth, density=0.5):
+    """Exponential fog: the fraction of the sky colour seen through a layer at the given depth"""
+    return 1 - np.exp(-density*depth)
+
+def fog(layer, colour, amount):
+    """Blend the colour of a layer toward the given (sky) colour, keeping its transparency (in place)"""
+    rgb = layer[:,:,0:3]
+    rgb *= (1-amount)
+    rgb += np.asarray(colour, dtype=layer.dtype) * amount
+    return layer
+
+def gaussian_kernel(sigma):
+    """Normalised 1D Gaussian kernel, truncated at 3 sigma"""
+    radius = max(1, int(np.ceil(3*sigma)))
+    x = np.arange(-radius, radius+1, dtype=np.float32)
+    kernel = np.exp(-0.5 * (x/sigma)**2)
+    return kernel / kernel.sum()
+
+def _convolve_axis(img, kernel, axis):
+    """Convolve an image with a 1D kernel along one axis (zero padded): one vectorised multiply-add per kernel tap"""
+    radius = len(kernel)//2
+    n = img.shape[axis]
+    pad = [(0,0)] * img.ndim
+    pad[axis] = (radius, radius)
+    padded = np.moveaxis(np.pad(img, pad), axis, 0)
+    out = np.zeros_like(padded[:n])
+    for i, k in enumerate(kernel):
+        out += k * padded[i:i+n]
+    return np.moveaxis(out, 0, axis)
+
+def blur(layer, sigma):
+    """Separable Gaussian blur of an RGBA layer (blurred with premultiplied alpha, so edges don't darken)"""
+    if sigma <= 0:
+        return layer
+    kernel = gaussian_kernel(sigma)
+    premultiplied = layer.copy()
+    premultiplied[:,:,0:3] *= layer[:,:,3:4]
+    out = _convolve_axis(_convolve_axis(premultiplied, kernel, 0), kernel, 1)
+    alpha = out[:,:,3:4]
+    np.divide(out[:,:,0:3], alpha, out=out[:,:,0:3], where=alpha > 0)
+    return np.clip(out, 0, 1, out=out)
+
+def composite(layers, background=None):
+    """Blend RGBA layers back-to-front (the first layer is furthest back) with the 'over' operator
+    Returns the RGBA result (over the background buffer, if given)"""
+    layers = list(layers)
+    out = np.zeros_like(layers[0]) if background is None else background.astype(np.float32, copy=True)
+    rgb, a = out[:,:,0:3], out[:,:,3:4]
+    for layer in layers:
+        src_a = layer[:,:,3:4]
+        # Colour is accumulated premultiplied, and divided back out at the end
+        rgb *= a * (1-src_a)
+        rgb += layer[:,:,0:3] * src_a
+        a *= (1-src_a)
+        a += src_a
+        np.divide(rgb, a, out=rgb, where=a > 0)
+    return out
+
+def depth_composite(layers, depths, sky_colour, background=None, fog_density=0.5, blur_scale=1.5, focus_depth=0.0):
+    """Apply fog & depth of field to each layer by its depth (0 = in focus & clear), then composite them
+    Layers are sorted back-to-front by depth; each is fogged toward sky_colour & blurred by
+    blur_scale * (depth - focus_depth) pixels (if positive)"""
+    order = np.argsort(depths)[::-1]
+    processed = []
+    for i in order:
+        layer = fog(layers[i].copy(), sky_colour, fog_amount(depths[i], fog_density))
+        processed.append(blur(layer, blur_scale * (depths[i] - focus_depth)))
+    return composite(processed, background)
@@ -1,10 +1,13 @@
 """
 config.py
 Contains some default parameters used to generate certain styles of trees & spikes
+Also contains a small "compiler" which validates these parameter sets, and freezes them (along with some
+pre-computed constants) into the named tuples which are used internally while generating trees
 """
 
 # Standard imports
-import copy
+import collections
+import math
 
 # Self imports
 import colours
@@ -13,6 +16,7 @@ import colours
 
 
 # The tree parameters are often the same, so we copy & inherit them to make it less verbose
+# (all the values are scalars, so a shallow copy is enough)
 # See repo docs for description of which trees are which
 tree_basic = {
     'angle':-90,
@@ -22,7 +26,7 @@ tree_basic = {
     'large_angle': 60,    
 }
 
-tree_type_i = copy.deepcopy(tree_basic)
+tree_type_i = dict(tree_basic)
 tree_type_i.update({
     'length_change':0.8,
     'length_vary_prop':0.2,
@@ -34,7 +38,7 @@ tree_type_i.update({
     'max_depth':6
 })
 
-tree_type_ii = copy.deepcopy(tree_basic)
+tree_type_ii = dict(tree_basic)
 tree_type_ii.update({
     'length_change':0.5,
     'length_vary_prop':0.1,
@@ -46,21 +50,31 @@ tree_type_ii.update({
     'max_depth':4
 })
 
-tree_type_ia = copy.deepcopy(tree_type_i)
+tree_type_ia = dict(tree_type_i)
 tree_type_ia.update({'split_prob_change': 0.9})
 
-tree_type_iia = copy.deepcopy(tree_type_ii)
+tree_type_iia = dict(tree_type_ii)
 tree_type_iia.update({'split_prob_change': 0.9})
 
-tree_type_ib = copy.deepcopy(tree_type_ia)
+tree_type_ib = dict(tree_type_ia)
 tree_type_ib.update({'large_angle_prob': 0.2})
 
-tree_type_iib = copy.deepcopy(tree_type_iia)
+tree_type_iib = dict(tree_type_iia)
 tree_type_iib.update({'large_angle_prob': 0.2})
 
 forest_trees = [tree_type_i, tree_type_ia, tree_type_ib, tree_type_ii, tree_type_iia, tree_type_iib]
 forest_probabilities = [0.1, 0.2, 0.2, 0.1, 0.2, 0.2]
 
+# Look-up of the tree types by their short name (e.g. 'ib' for Type Ib), in the same order as forest_trees
+tree_types = {
+    'i': tree_type_i,
+    'ia': tree_type_ia,
+    'ib': tree_type_ib,
+    'ii': tree_type_ii,
+    'iia': tree_type_iia,
+    'iib': tree_type_iib
+}
+
 
 # Forward-facing green spike leaves
 spikes_green = {
@@ -111,4 +125,99 @@ spikes_brown = {
                 "spike_density_y":6,
                 "spike_density_rnd":10,
                 "spike_max_angle":15
-}
\ No newline at end of file
+}
+
+
+# Compiled parameter sets
+# The dicts above are convenient to edit & pass as **kwargs, but the tree generation works on frozen named tuples,
+# so they are validated once, and derived constants are not recomputed at every branch
+TreeParams = collections.namedtuple('TreeParams', [
+    # As per the dicts above
+    'length_change', 'length_vary_prop', 'length_width', 'width_change',
+    'angle', 'angle_change', 'angle_vary_prop', 'large_angle_prob', 'large_angle',
+    'split_prob', 'split_prob_change', 'depth', 'max_depth',
+    # Derived
+    'angle_rad', 'angle_change_rad', 'large_angle_rad',
+    'split_probs' # split probability used at each depth (indexed by depth, which counts down to 1)
+])
+
+SpikeParams = collections.namedtuple('SpikeParams', [
+    # As per the dicts above (colours are stored as tuples, so the parameters are hashable)
+    'spike_direction', 'spike_colour', 'spike_edge_colour', 'spike_edge_width', 'spike_colour_jitter',
+    'spike_width', 'spike_length', 'spike_jitter', 'spike_layout',
+    'spike_density_x', 'spike_density_y', 'spike_density_rnd', 'spike_max_angle',
+    # Derived
+    'nx',               # number of spikes across a branch (regular layout)
+    'spike_reach',      # signed spike length (relative to the branch width)
+    'spike_angle_scale' # signed maximum spike angle in radians
+])
+
+tree_param_names = TreeParams._fields[:TreeParams._fields.index('angle_rad')]
+spike_param_names = SpikeParams._fields[:SpikeParams._fields.index('nx')]
+
+# Validation raises exceptions (rather than using assert), so it isn't skipped when running with python -O
+def _check(condition, message):
+    if not condition:
+        raise ValueError(message)
+
+def _check_names(params, names, kind):
+    missing = [k for k in names if k not in params]
+    unknown = [k for k in params if k not in names]
+    if missing:
+        raise TypeError("Missing {} parameters: {}".format(kind, missing))
+    if unknown:
+        raise TypeError("Unknown {} parameters: {}".format(kind, unknown))
+
+def compile_tree(params):
+    """Validate a dict of tree parameters (e.g. tree_type_i) and freeze it into a TreeParams"""
+    if isinstance(params, TreeParams):
+        return params
+    _check_names(params, tree_param_names, 'tree')
+    p = dict(params)
+    _check(int(p['depth']) == p['depth'] and p['depth'] >= 0, "depth must be a non-negative integer")
+    _check(p['max_depth'] >= 1, "max_depth must be at least 1")
+    # Split probabilities above 1 are allowed (as probabilities, they are 1): with split_prob_change < 1, they force
+    # the splits on the first levels
+    _check(p['split_prob'] >= 0 and p['split_prob_change'] >= 0, "split_prob & split_prob_change must be non-negative")
+    _check(0 <= p['large_angle_prob'] <= 1, "large_angle_prob must be between 0 and 1")
+    _check(p['length_change'] > 0 and p['width_change'] > 0 and p['length_width'] > 0, "length_change, width_change & length_width must be positive")
+    _check(p['length_vary_prop'] >= 0 and p['angle_vary_prop'] >= 0, "length_vary_prop & angle_vary_prop must be non-negative")
+    p['depth'] = int(p['depth'])
+    # The split probability is reduced before it is used at each depth
+    split_probs = [None] * (p['depth']+1)
+    split_prob = p['split_prob']
+    for depth in range(p['depth'], 0, -1):
+        split_prob = split_prob * p['split_prob_change']
+        split_probs[depth] = split_prob
+    return TreeParams(
+        angle_rad=math.radians(p['angle']),
+        angle_change_rad=math.radians(p['angle_change']),
+        large_angle_rad=math.radians(p['large_angle']),
+        split_probs=tuple(split_probs),
+        **p)
+
+def compile_spikes(params):
+    """Validate a dict of spike parameters (e.g. spikes_green) and freeze it into a SpikeParams"""
+    if isinstance(params, SpikeParams):
+        return params
+    _check_names(params, spike_param_names, 'spike')
+    p = dict(params)
+    _check(p['spike_direction'] in (1, -1), "spike_direction must be 1 (forwards) or -1 (backwards)")
+    _check(p['spike_layout'] in ('regular', 'random'), "spike_layout must be 'regular' or 'random'")
+    _check(0 <= p['spike_colour_jitter'] <= 1, "spike_colour_jitter must be between 0 and 1")
+    _check(p['spike_width'] > 0 and p['spike_length'] > 0, "spike_width & spike_length must be positive")
+    _check(p['spike_density_x'] > 0 and p['spike_density_y'] > 0 and p['spike_density_rnd'] >= 0, "spike densities must be positive")
+    if not isinstance(p['spike_colour'], str): p['spike_colour'] = tuple(p['spike_colour'])
+    if not isinstance(p['spike_edge_colour'], str): p['spike_edge_colour'] = tuple(p['spike_edge_colour'])
+    return SpikeParams(
+        nx=int(math.ceil((1 / p['spike_width']) * p['spike_density_x'])),
+        spike_reach=p['spike_direction'] * p['spike_length'],
+        spike_angle_scale=math.radians(p['spike_direction'] * p['spike_max_angle']),
+        **p)
+
+# Compiled versions of the presets above
+compiled_tree_types = {k: compile_tree(v) for k, v in tree_types.items()}
+compiled_forest_trees = [compile_tree(t) for t in forest_trees]
+compiled_spikes_green = compile_spikes(spikes_green)
+compiled_spikes_yellow = compile_spikes(spikes_yellow)
+compiled_spikes_brown = compile_spikes(spikes_brown)
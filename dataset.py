@@ -0,0 +1,154 @@
+"""
+dataset.py
+Command line tool to bulk generate labelled Joshua Tree images (e.g. as synthetic training data)
+    * one random tree per image, with the tree type drawn from a configurable mix of config.tree_types
+    * images are written in shards, each with a metadata.jsonl file (tree type, seed, segment count, bounding box)
+    * finished shards are recorded in a checkpoint file, so an interrupted run can be resumed
+    * shards are rendered in parallel across all cores
+
+Example:
+    python dataset.py out/ --count 100000 --size 256 256 --seed-start 0 --mix i=1,ia=2,ib=2,ii=1,iia=2,iib=2
+"""
+
+# Standard imports
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# Self imports
+import config
+import tree
+
+CHECKPOINT_FILE = 'checkpoint.json'
+METADATA_FILE = 'metadata.jsonl'
+DPI = 100
+
+def parse_mix(mix):
+    """Parse a tree type mix such as 'i=1,ib=2' into (names, probabilities)
+    If mix is None, the default forest probabilities from config.py are used"""
+    if mix is None:
+        return list(config.tree_types.keys()), list(config.forest_probabilities)
+    names, weights = [], []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip().lower()
+        if name not in config.tree_types:
+            raise ValueError("Unknown tree type '{}' (choose from {})".format(name, ', '.join(config.tree_types)))
+        names.append(name)
+        weights.append(float(weight) if weight else 1.0)
+    weights = np.array(weights)
+    if np.any(weights < 0) or weights.sum() <= 0:
+        raise ValueError("Tree type weights must be non-negative and not all zero")
+    return names, list(weights / weights.sum())
+
+def draw_sample(seed, names, probabilities, length=10):
+    """Draw a single random tree on the current axis, with its type drawn from the given mix
+    Returns the metadata of the tree (type, seed, segment count and bounding box in data coordinates)"""
+    np.random.seed(seed)
+    name = names[np.random.choice(len(names), p=probabilities)]
+    n_segments = tree.draw_joshua_tree(length=length, **config.tree_types[name])
+    bbox = plt.gca().dataLim
+    return {
+        'tree_type': name,
+        'seed': int(seed),
+        'segments': int(n_segments),
+        'bbox_data': [float(bbox.x0), float(bbox.y0), float(bbox.x1), float(bbox.y1)]
+    }
+
+def shard_dir(out_dir, shard):
+    return os.path.join(out_dir, 'shard-{:05d}'.format(shard))
+
+def render_shard(job):
+    """Render every image of one shard, writing the PNGs and then the shard's metadata file
+    The metadata file is written last (atomically), so a shard is only complete once it exists"""
+    out_dir, shard, seeds, w, h, names, probabilities = job
+    path = shard_dir(out_dir, shard)
+    os.makedirs(path, exist_ok=True)
+    fig = plt.figure(figsize=(w/DPI, h/DPI), dpi=DPI)
+    records = []
+    for seed in seeds:
+        fig.clf()
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.axis('off')
+        meta = draw_sample(seed, names, probabilities)
+        meta['bbox'] = tree.fit_axis(ax, meta['bbox_data'], w, h)
+        meta['image'] = '{:09d}.png'.format(seed)
+        meta['width'], meta['height'] = w, h
+        fig.savefig(os.path.join(path, meta['image']), dpi=DPI)
+        records.append(meta)
+    plt.close(fig)
+    tmp = os.path.join(path, METADATA_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        for meta in records:
+            f.write(json.dumps(meta) + '\n')
+    os.replace(tmp, os.path.join(path, METADATA_FILE))
+    return shard
+
+def load_checkpoint(out_dir, settings):
+    """Load the set of finished shards, checking the run settings match those of the checkpoint"""
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['settings'] != settings:
+        raise ValueError("Checkpoint in {} was written with different settings: {}".format(out_dir, checkpoint['settings']))
+    return set(checkpoint['done'])
+
+def save_checkpoint(out_dir, settings, done):
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'settings': settings, 'done': sorted(done)}, f)
+    os.replace(path + '.tmp', path)
+
+def generate(out_dir, count, w=256, h=256, seed_start=0, mix=None, shard_size=1000, workers=None, verbose=True):
+    """Generate `count` images (seeds seed_start, seed_start+1, ...) into sharded folders of out_dir
+    Shards already recorded in the checkpoint are skipped, so calling this again resumes an interrupted run"""
+    names, probabilities = parse_mix(mix)
+    settings = {
+        'count': count,
+        'size': [w, h],
+        'seed_start': seed_start,
+        'mix': dict(zip(names, probabilities)),
+        'shard_size': shard_size
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    done = load_checkpoint(out_dir, settings)
+    n_shards = int(np.ceil(count / shard_size))
+    jobs = []
+    for shard in range(n_shards):
+        if shard in done:
+            continue
+        first = seed_start + shard*shard_size
+        seeds = range(first, min(first+shard_size, seed_start+count))
+        jobs.append((out_dir, shard, seeds, w, h, names, probabilities))
+    if verbose and done:
+        print("Resuming: {} of {} shards already done".format(len(done), n_shards))
+    with multiprocessing.Pool(workers) as pool:
+        for shard in pool.imap_unordered(render_shard, jobs):
+            done.add(shard)
+            save_checkpoint(out_dir, settings, done)
+            if verbose:
+                print("Shard {} done ({}/{})".format(shard, len(done), n_shards))
+    return n_shards
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk generate labelled Joshua Tree images")
+    parser.add_argument('out_dir', help="Output folder (shards, metadata & checkpoint are written here)")
+    parser.add_argument('--count', type=int, required=True, help="Number of images to generate")
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 256], metavar=('W', 'H'), help="Image size in pixels")
+    parser.add_argument('--seed-start', type=int, default=0, help="Seed of the first image (image k uses seed-start + k)")
+    parser.add_argument('--mix', default=None, help="Tree type weights, e.g. 'i=1,ib=2' (default: config.forest_probabilities)")
+    parser.add_argument('--shard-size', type=int, default=1000, help="Number of images per shard")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+    generate(args.out_dir, args.count, args.size[0], args.size[1], args.seed_start, args.mix, args.shard_size, args.workers)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -8,24 +8,25 @@ Contains some simple functions, which when combined produce some twilight/night
 """
 
 # Standard imports
-import matplotlib.pyplot as plt
 import numpy as np
 import bisect
+# matplotlib.pyplot is only imported inside the drawing functions, so the terrain generation can be imported without it
 
 # Self imports
 import colours
 
 def draw_sky(w=1600, h=900, cmap=None):
     """Draw a gradient filled sky on the current axis"""
+    import matplotlib.pyplot as plt
     if cmap is None:
         rnd_key = np.random.choice(list(colours.cmaps.keys()))
         cmap = colours.cmaps[rnd_key]
-    plt.xlim(0,width)
-    plt.ylim(0,height)
+    plt.xlim(0,w)
+    plt.ylim(0,h)
     plt.imshow([[0, 0],[1, 1]], cmap=cmap, interpolation='bicubic', extent=plt.xlim()+plt.ylim(), zorder=0)
     return True
 
-def midpoint_displacement(start, end, roughness, vertical_displacement=None, num_of_iterations=16):
+def midpoint_displacement(start, end, roughness, vertical_displacement=None, num_of_iterations=16, dtype=np.float64):
     """
 	Iterative midpoint vertical displacement (https://bitesofcode.wordpress.com/2016/12/23/landscape-generation-using-midpoint-displacement/)
 	Given a straight line segment specified by a starting point and an endpoint
@@ -34,6 +35,7 @@ def midpoint_displacement(start, end, roughness, vertical_displacement=None, num
     iterations > 0 applies the  midpoint algorithm to the specified segment and
     returns the obtained list of points in the form
     points = [[x_0, y_0],[x_1, y_1],...,[x_n, y_n]]
+    (as a numpy array of the given dtype)
     """
     # Final number of points = (2^iterations)+1
     if vertical_displacement is None:
@@ -72,10 +74,40 @@ def midpoint_displacement(start, end, roughness, vertical_displacement=None, num
         vertical_displacement *= 2 ** (-roughness)
         # update number of iterations
         iteration += 1
-    return np.array(points)
+    return np.array(points, dtype=dtype)
+
+def spectral_displacement(start, end, roughness, vertical_displacement=None, num_of_iterations=16, dtype=np.float64):
+    """
+    Spectral synthesis terrain: a faster, smoother alternative to midpoint_displacement, taking the same arguments
+    Random 1/f^beta noise is made with a single inverse FFT of length 2^num_of_iterations, so it is O(n log n) at any resolution
+    The midpoint displacement shrinks by 2^-roughness each time the scale halves, which is fractional Brownian motion
+    with Hurst exponent H=roughness, i.e. a power spectrum of 1/f^beta with beta = 2*roughness + 1
+    vertical_displacement sets the scale of the ridges (matching the typical height of midpoint_displacement's)
+    Returns the (2^num_of_iterations)+1 points [[x_0, y_0],[x_1, y_1],...,[x_n, y_n]] as a numpy array
+    """
+    if vertical_displacement is None:
+        vertical_displacement = (start[1]+end[1])/2
+    n = 2**num_of_iterations
+    beta = 2*roughness + 1
+    # Random complex amplitudes with a 1/f^beta power spectrum (no constant term)
+    f = np.arange(1, n//2 + 1)
+    spectrum = np.zeros(n//2 + 1, dtype=complex)
+    spectrum[1:] = (np.random.normal(size=len(f)) + 1j*np.random.normal(size=len(f))) * f**(-beta/2)
+    noise = np.fft.irfft(spectrum, n)
+    # The noise is periodic, so it starts & ends at the same height: close the loop, then add the start->end slope
+    noise = np.append(noise, noise[0]) - noise[0]
+    # Scale to the typical spread of midpoint_displacement's terrain (found empirically) for the same displacement:
+    # the spread of num_of_iterations displacements, each 2^-roughness times the last (finite for any roughness)
+    levels = 4.0**(-roughness*np.arange(num_of_iterations))
+    noise *= 0.35 * vertical_displacement * np.sqrt(levels.sum()) / max(noise.std(), 1e-12)
+    points = np.empty((n+1, 2), dtype=dtype)
+    points[:,0] = np.linspace(start[0], end[0], n+1)
+    points[:,1] = np.linspace(start[1], end[1], n+1) + noise
+    return points
 
 def draw_uniform_stars(w, h, n=100, max_size=5, col='w'):
     """Draw n stars at random positions, with random sizes on the current axis"""
+    import matplotlib.pyplot as plt
     stars = np.random.random((n,3)) * np.array([w, h, max_size])
     plt.scatter(stars[:,0], stars[:,1], s=stars[:,2], c=col, zorder=1)
     return stars
@@ -96,35 +128,49 @@ def draw_stars(w=1600, h=900, n=750, max_size=5, col='w', n_ratios=[0.005,0.15,0
     draw_uniform_stars(w, h, n=n_med  , col=col, max_size=s_med)
     draw_uniform_stars(w, h, n=n_small, col=col, max_size=s_small)
 
-def draw_terrain(start, end, roughness, vertical_displacement=None, num_of_iterations=16, col='k'):
+def draw_terrain(start, end, roughness, vertical_displacement=None, num_of_iterations=16, col='k', dtype=np.float64, engine='midpoint'):
     """Draw a randomly generated terrain on the current axis, in a given colour
+    engine is 'midpoint' (midpoint_displacement) or 'spectral' (spectral_displacement: smoother, & much faster at high resolution)
     Returns a numpy array of the (x,y) points which define the terrain
     """
-    layer = midpoint_displacement(start, end, roughness, vertical_displacement, num_of_iterations)
+    import matplotlib.pyplot as plt
+    engines = {'midpoint': midpoint_displacement, 'spectral': spectral_displacement}
+    if engine not in engines:
+        raise ValueError("Terrain engine must be one of {}".format(list(engines)))
+    layer = engines[engine](start, end, roughness, vertical_displacement, num_of_iterations, dtype)
     plt.fill_between(layer[:,0], layer[:,1], y2=0, color=col, zorder=3)
     return layer
 
-def makeGaussian(size, fwhm=3, center=None):
+def makeGaussian(size, fwhm=3, center=None, dtype=np.float64):
     """ Make a square gaussian kernel (https://stackoverflow.com/questions/7687679/how-to-generate-2d-gaussian-with-python)
     size is the length of a side of the square
     fwhm is full-width-half-maximum, which
     can be thought of as an effective radius.
     """
-    x = np.arange(0, size, 1, float)
+    x = np.arange(0, size, 1, dtype)
     y = x[:,np.newaxis]
     if center is None:
         x0 = y0 = size // 2
     else:
         x0 = center[0]
         y0 = center[1]
-    return np.exp(-4*np.log(2) * ((x-x0)**2 + (y-y0)**2) / fwhm**2)
+    if np.dtype(dtype) == np.float64:
+        return np.exp(-4*np.log(2) * ((x-x0)**2 + (y-y0)**2) / fwhm**2)
+    # Separable & in place: exp(a*(dx^2 + dy^2)) = exp(a*dx^2) * exp(a*dy^2)
+    scalar = np.dtype(dtype).type
+    a = scalar(-4*np.log(2) / fwhm**2)
+    gx = np.exp(a * (x-scalar(x0))**2)
+    gy = np.exp(a * (y-scalar(y0))**2)
+    return np.multiply(gy, gx)
 
-def draw_sun(w=1600, h=900, center=None, size=None, terrain=None, col=[1,1,1]):
+def draw_sun(w=1600, h=900, center=None, size=None, terrain=None, col=[1,1,1], dtype=np.float64):
     """Draw the sun/moon brightness effect on the current axis (essentially this is a white Gaussian blob)
     If terrain provided, position is random (x) and at the height of the terrain (y)
     if center not provided, position is random (x,y)
     If center provided, use it
+    The image is built in the given dtype: np.float32 or np.uint8 use a half/eighth of the memory of np.float64
     """
+    import matplotlib.pyplot as plt
     # Find crop factor
     crop = int((max(w,h)-min(w,h))/2)
     # Set it at random (x) and near terrain (y)
@@ -143,13 +189,21 @@ def draw_sun(w=1600, h=900, center=None, size=None, terrain=None, col=[1,1,1]):
     # Set size
     if size is None: size = int(w / 5)
     # Make blob
-    g = makeGaussian(max(w,h), fwhm=size, center=center)
+    float_dtype = np.float32 if np.dtype(dtype) == np.uint8 else dtype
+    g = makeGaussian(max(w,h), fwhm=size, center=center, dtype=float_dtype)
     # Crop the larger axis
     if w > h: g = g[crop:-crop,:]
     elif h > w: g = g[:,crop:-crop]
     # Assign colour & transparency
-    img = np.ones((h, w, 4))
-    img[:,:,0:3] = img[:,:,0:3] * np.array(col) #set RGB colour
-    img[:,:,3] = g #alpha channel
+    if np.dtype(dtype) == np.float64:
+        img = np.ones((h, w, 4))
+        img[:,:,0:3] = img[:,:,0:3] * np.array(col) #set RGB colour
+        img[:,:,3] = g #alpha channel
+    else:
+        scale = 255 if np.dtype(dtype) == np.uint8 else 1
+        img = np.empty((h, w, 4), dtype=dtype)
+        img[:,:,0:3] = np.rint(np.array(col) * scale) if scale != 1 else np.array(col) #set RGB colour
+        if scale != 1: g = np.rint(g * scale, out=g)
+        img[:,:,3] = g #alpha channel
     # Draw
     plt.imshow(img, zorder=2)
\ No newline at end of file
@@ -0,0 +1,224 @@
+"""
+regression.py
+Golden geometry regression harness, which pins down the exact output of the tree & terrain generation for fixed seeds
+    * capture() generates canonical geometry for every config.tree_type_* (with every spike preset), and some terrains
+    * each array is recorded as a hash (for exact matches), and for tolerance-based comparison, as a sample of at most
+      SAMPLE_ROWS of its rows (float32) & its column sums: the golden file stays small (re-recording it doesn't add
+      megabytes to the history), but an array whose hash differs is only compared within tolerance on these
+    * compare() reports whether each array is identical, equivalent within tolerance, or different
+    * lod_changes() checks that lowering the level of detail (see budget.thin_geometry) only removes spikes, and never
+      changes a tree's branches
+
+Usage:
+    python regression.py record                  # capture the current output as the golden reference
+    python regression.py check                   # compare the current output against the golden reference
+    python regression.py check --diverge 'terrain*'  # ... stating that the terrain is intentionally different
+    python regression.py check --dtype float32 --atol 3e-3  # ... for the memory-lean float32 pipeline
+"""
+
+# Standard imports
+import argparse
+import collections
+import fnmatch
+import hashlib
+import os
+import sys
+import numpy as np
+
+# Self imports
+import budget
+import config
+import landscape
+import tree
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden', 'geometry.npz')
+SEEDS = [0, 1, 2]
+
+# The arrays recorded for each tree (all fields of tree.TreeGeometry which are arrays)
+# Levels of detail at which the trees' branches must be the same as at full detail
+LODS = [0.8, 0.5, 0.3]
+
+# Rows of each array kept in the golden file (evenly spaced, including the first & last)
+SAMPLE_ROWS = 64
+
+TREE_FIELDS = ['segments', 'segment_widths', 'segment_zorders', 'rects', 'rect_zorders', 'spikes', 'spike_colours', 'spike_layers', 'spike_zorders']
+
+def tree_cases():
+    """Name & keyword arguments of every tree captured by the harness"""
+    cases = []
+    # Every tree type, with the default (green, yellow & brown) spike presets
+    for name, params in config.tree_types.items():
+        for seed in SEEDS:
+            cases.append(('tree_{}_seed{}'.format(name, seed), dict(seed=seed, **params)))
+    # Every spike preset on its own, in both layouts
+    for layer, spike_name in enumerate(['spikes_brown', 'spikes_green', 'spikes_yellow']):
+        for layout in ['regular', 'random']:
+            spikes = dict(getattr(config, spike_name), spike_layout=layout)
+            draw_texture = [i == layer for i in range(3)]
+            kwargs = dict(seed=SEEDS[0], draw_texture=draw_texture, spike_back_params=spikes, spike_forward_params=spikes, spike_mid_params=spikes)
+            cases.append(('{}_{}'.format(spike_name, layout), dict(kwargs, **config.tree_type_i)))
+    # Darkened colours, rectangular segments & a random tree type
+    cases.append(('tree_ib_darken_rect', dict(seed=SEEDS[1], darken=0.8, draw_rect=True, **config.tree_type_ib)))
+    cases.append(('random_tree_seed27182', dict(seed=27182)))
+    return cases
+
+def terrain_cases():
+    """Name & arguments of every terrain captured by the harness (similar to the example scenes), with both engines"""
+    return [
+        ('terrain_eg5', 41, ([0, 150], [1600, 170], 1.1, 100, 8)),
+        ('terrain_eg6', 10001, ([0, 100], [1600, 100], 1.1, 200, 8)),
+        ('terrain_eg7', 2, ([0, 200], [1600, 200], 1.2, 80, 8)),
+        ('terrain_fine', 0, ([0, 0], [1600, 0], 1.0, 50, 12)),
+        ('terrain_flat_roughness', 3, ([0, 100], [1600, 100], 0.0, 10, 6))
+    ]
+
+def capture(tree_kwargs=None, terrain_kwargs=None):
+    """Generate the canonical geometry; extra keyword arguments can be passed to every tree/terrain call
+    Returns a dict of {name: array}"""
+    tree_kwargs = tree_kwargs or {}
+    terrain_kwargs = terrain_kwargs or {}
+    arrays = {}
+    for name, kwargs in tree_cases():
+        kwargs = dict(kwargs, **tree_kwargs)
+        if name.startswith('random_tree'):
+            geometry = tree.generate_random_joshua_tree(**kwargs)
+        else:
+            geometry = tree.generate_joshua_tree(**kwargs)
+        for field in TREE_FIELDS:
+            a = np.asarray(getattr(geometry, field))
+            if a.dtype == np.uint8: # lean colours are compared as 0-1 floats
+                a = a / 255
+            arrays['{}/{}'.format(name, field)] = a
+    for name, seed, args in terrain_cases():
+        np.random.seed(seed)
+        arrays['{}/points'.format(name)] = np.asarray(landscape.midpoint_displacement(*args, **terrain_kwargs))
+        np.random.seed(seed)
+        arrays['{}/spectral_points'.format(name)] = np.asarray(landscape.spectral_displacement(*args, **terrain_kwargs))
+    return arrays
+
+def lod_changes(lods=LODS):
+    """Names of the tree cases (with the level of detail) whose branch segments change with the level of detail"""
+    changed = []
+    for name, kwargs in tree_cases():
+        kind = 'random' if name.startswith('random_tree') else 'joshua'
+        full = budget.generate(kind, kwargs)
+        for lod in lods:
+            thinned = budget.generate(*budget.apply_lod([(kind, kwargs)], lod)[0])
+            if not all(np.array_equal(getattr(full, k), getattr(thinned, k)) for k in ['segments', 'segment_widths', 'segment_zorders', 'rects']):
+                changed.append('{}@lod{}'.format(name, lod))
+    return changed
+
+def array_hash(a):
+    """Hash of an array's dtype, shape & contents"""
+    a = np.ascontiguousarray(a)
+    h = hashlib.sha256()
+    h.update('{}{}'.format(a.dtype.str, a.shape).encode())
+    h.update(a.tobytes())
+    return h.hexdigest()
+
+# Reference of an array for tolerance-based comparison (see reference)
+Reference = collections.namedtuple('Reference', ['shape', 'sample', 'sums'])
+
+def reference(a):
+    """Reference of an array: its shape, a sample of its rows (float32, if it's floating point) & its column sums
+    (the sums, & the sums of the absolute values, of all its rows, as float64)"""
+    a = np.asarray(a)
+    rows = np.unique(np.linspace(0, len(a)-1, min(len(a), SAMPLE_ROWS)).round().astype(int))
+    sample = a[rows]
+    if sample.dtype.kind == 'f':
+        sample = sample.astype(np.float32)
+    sums = np.stack([a.sum(axis=0, dtype=np.float64), np.abs(a).sum(axis=0, dtype=np.float64)])
+    return Reference(a.shape, sample, sums)
+
+def _equivalent(a, ref, rtol, atol):
+    """Whether an array matches a reference within tolerance: the same shape, sample rows & column sums (where the
+    tolerance of a sum is that of all its rows)"""
+    if a.shape != ref.shape:
+        return False
+    current = reference(a)
+    return (np.allclose(current.sample, ref.sample, rtol=rtol, atol=atol) and
+            np.all(np.abs(current.sums[0] - ref.sums[0]) <= atol*max(len(a), 1) + rtol*ref.sums[1]))
+
+def record(path=GOLDEN_FILE):
+    """Capture the current geometry & save it as the golden reference (hashes & references)"""
+    arrays = capture()
+    hashes = np.array(['{}={}'.format(k, array_hash(v)) for k, v in arrays.items()])
+    shapes = np.array(['{}={}'.format(k, ','.join(map(str, v.shape))) for k, v in arrays.items()])
+    data = {}
+    for k, v in arrays.items():
+        ref = reference(v)
+        data[k] = ref.sample
+        data[k + '@sums'] = ref.sums
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(path, __hashes__=hashes, __shapes__=shapes, **data)
+    return arrays
+
+def load(path=GOLDEN_FILE):
+    """Load the golden reference: returns ({name: Reference}, {name: hash})"""
+    with np.load(path) as data:
+        hashes = dict(h.split('=', 1) for h in data['__hashes__'])
+        shapes = dict(s.split('=', 1) for s in data['__shapes__'])
+        references = {k: Reference(tuple(int(n) for n in shape.split(',') if n), data[k], data[k + '@sums'])
+                      for k, shape in shapes.items()}
+    return references, hashes
+
+def compare(golden, hashes, current, rtol=1e-5, atol=1e-6, diverge=()):
+    """Compare current arrays against the golden references (see reference)
+    Cases matching any of the fnmatch patterns in `diverge` are expected to be different (an intentional divergence)
+    Returns a dict of {name: status}, where status is one of:
+        'identical' (same hash), 'equivalent' (within tolerance), 'different', 'diverged' (different, as expected),
+        'missing' (in the golden reference only) or 'new' (in the current arrays only)"""
+    status = {}
+    for name in sorted(set(golden) | set(current)):
+        if name not in current:
+            status[name] = 'missing'
+        elif name not in golden:
+            status[name] = 'new'
+        elif array_hash(current[name]) == hashes.get(name):
+            status[name] = 'identical'
+        elif _equivalent(current[name], golden[name], rtol, atol):
+            status[name] = 'equivalent'
+        elif any(fnmatch.fnmatch(name, pattern) for pattern in diverge):
+            status[name] = 'diverged'
+        else:
+            status[name] = 'different'
+    return status
+
+def check(path=GOLDEN_FILE, rtol=1e-5, atol=1e-6, diverge=(), tree_kwargs=None, terrain_kwargs=None, verbose=True):
+    """Capture the current geometry & compare it against the golden reference, and check the trees' branches don't
+    change with the level of detail
+    Returns True if nothing is unexpectedly different (or missing)"""
+    golden, hashes = load(path)
+    status = compare(golden, hashes, capture(tree_kwargs, terrain_kwargs), rtol, atol, diverge)
+    failed = [k for k, v in status.items() if v in ('different', 'missing')]
+    changed = lod_changes()
+    if verbose:
+        counts = {}
+        for v in status.values():
+            counts[v] = counts.get(v, 0) + 1
+        for name in failed:
+            print("{}: {}".format(name, status[name]))
+        for name in changed:
+            print("{}: branches changed with the level of detail".format(name))
+        print(", ".join("{} {}".format(n, s) for s, n in sorted(counts.items())))
+    return not failed and not changed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Golden geometry regression harness")
+    parser.add_argument('command', choices=['record', 'check'])
+    parser.add_argument('path', nargs='?', default=GOLDEN_FILE, help="Golden reference file")
+    parser.add_argument('--rtol', type=float, default=1e-5, help="Relative tolerance of array comparisons")
+    parser.add_argument('--atol', type=float, default=1e-6, help="Absolute tolerance of array comparisons")
+    parser.add_argument('--diverge', action='append', default=[], help="Pattern of case names which are intentionally different")
+    parser.add_argument('--dtype', default=None, help="Check the geometry generated with this dtype (e.g. float32)")
+    args = parser.parse_args(argv)
+    if args.command == 'record':
+        arrays = record(args.path)
+        print("Recorded {} arrays to {}".format(len(arrays), args.path))
+        return 0
+    tree_kwargs = {'dtype': np.dtype(args.dtype)} if args.dtype else None
+    terrain_kwargs = {'dtype': np.dtype(args.dtype)} if args.dtype else None
+    return 0 if check(args.path, args.rtol, args.atol, args.diverge, tree_kwargs, terrain_kwargs) else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
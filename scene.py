@@ -0,0 +1,407 @@
+"""
+scene.py
+Declarative scenes: a scene is described by a JSON (or YAML) spec of layers, instead of a script of drawing calls
+    * each layer (sky, stars, terrain, sun, trees) has its own seed, so it always draws the same thing
+    * trees can use the presets from config.py, and be placed on a terrain layer (at a height relative to it)
+    * layers are drawn back to front, in the order they are listed
+    * SceneRenderer renders each layer on its own (see compositing.render_layer) & caches it, so when the spec
+      changes only the changed layers (& the layers which depend on them) are redrawn, and re-composited
+    * an optional budget caps the trees' segments, spikes, artists & bytes (see budget.py): the spikes of every tree
+      are thinned until the scene fits (down to min_lod), otherwise the scene is refused
+
+Example spec:
+    {
+      "width": 1600, "height": 900, "seed": 41, "budget": {"spikes": 200000, "min_lod": 0.25},
+      "layers": [
+        {"name": "sky", "type": "sky", "cmap": "crimson_tide"},
+        {"name": "sun", "type": "sun", "size": 800, "terrain": "ridge"},
+        {"name": "ridge", "type": "terrain", "start": [0, 150], "end": [1600, 170], "roughness": 1.1,
+         "vertical_displacement": 100, "num_of_iterations": 8, "col": "0.1"},
+        {"name": "trees", "type": "tree", "preset": "ia", "x": [0.4, 0.8], "terrain": "ridge", "offset": [-50, -100],
+         "length": [200, 350], "params": {"darken": 0.9}}
+      ]
+    }
+
+Usage:
+    python scene.py scenes/example5.json out.png
+    python scene.py scenes/example5.json out.png --watch   # re-render (incrementally) whenever the spec changes
+"""
+
+# Standard imports
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import sys
+import time
+import zlib
+import numpy as np
+
+# Self imports
+import budget
+import colours
+import compositing
+import config
+import landscape
+import tree
+
+# Arguments of each layer type, passed on to the drawing functions (besides name, type, seed & the tree placement)
+LAYER_TYPES = {
+    'sky': ['cmap'],
+    'stars': ['n', 'max_size', 'col', 'n_ratios', 's_ratios'],
+    'terrain': ['start', 'end', 'roughness', 'vertical_displacement', 'num_of_iterations', 'col', 'engine'],
+    'sun': ['center', 'size', 'terrain', 'col'],
+    'tree': ['preset', 'x', 'y', 'terrain', 'offset', 'length', 'width', 'params'],
+    'dead_tree': ['x', 'y', 'terrain', 'offset', 'length', 'width', 'params']
+}
+
+# Tree arguments which can be given once per tree (as a list the same length as x)
+PER_TREE = ['x', 'y', 'offset', 'length', 'width']
+
+# Drawing function of each kind of tree (see tree_jobs), whose defaults are part of a tree layer's key
+TREE_FUNCTIONS = {
+    'joshua': tree.draw_joshua_tree,
+    'random': tree.draw_random_joshua_tree,
+    'dead': tree.draw_dead_tree
+}
+
+# Lowest level of detail a budget can lower the trees to (unless the spec's budget has its own min_lod)
+MIN_LOD = 0.1
+
+def load_scene(path):
+    """Load a scene spec from a JSON or YAML (.yaml/.yml, needs PyYAML) file, and validate it"""
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is needed to load YAML scenes (or use a JSON spec instead)")
+            scene = yaml.safe_load(f)
+        else:
+            scene = json.load(f)
+    return validate_scene(scene)
+
+def validate_scene(scene):
+    """Check a scene spec, and fill in the defaults (size, seed & layer names)
+    Raises ValueError if it is invalid (rather than asserting, so it is still checked with python -O)
+    Returns a new spec"""
+    scene = dict(scene)
+    scene.setdefault('width', 1600)
+    scene.setdefault('height', 900)
+    scene.setdefault('seed', 0)
+    if scene['width'] <= 0 or scene['height'] <= 0:
+        raise ValueError("Scene width & height must be positive")
+    layers = []
+    terrains = [l.get('name', 'terrain{}'.format(i)) for i, l in enumerate(scene.get('layers', [])) if l.get('type') == 'terrain']
+    for i, layer in enumerate(scene.get('layers', [])):
+        layer = dict(layer)
+        if layer.get('type') not in LAYER_TYPES:
+            raise ValueError("Layer {} type must be one of {}".format(i, list(LAYER_TYPES)))
+        layer.setdefault('name', '{}{}'.format(layer['type'], i))
+        unknown = [k for k in layer if k not in LAYER_TYPES[layer['type']] + ['name', 'type', 'seed']]
+        if unknown:
+            raise ValueError("Unknown arguments of layer '{}': {}".format(layer['name'], unknown))
+        if 'terrain' in layer:
+            if layer['terrain'] not in terrains:
+                raise ValueError("Layer '{}' is placed on terrain '{}', which is not a terrain layer".format(layer['name'], layer['terrain']))
+        if layer['type'] == 'tree':
+            preset = layer.get('preset', 'random')
+            if preset != 'random' and preset not in config.tree_types:
+                raise ValueError("Tree preset must be 'random' or one of {}".format(list(config.tree_types)))
+        if layer['type'] in ('tree', 'dead_tree'):
+            if 'x' not in layer:
+                raise ValueError("Tree layer '{}' needs an x position".format(layer['name']))
+            if 'y' not in layer and 'terrain' not in layer:
+                raise ValueError("Tree layer '{}' needs a y position or a terrain".format(layer['name']))
+        layers.append(layer)
+    names = [l['name'] for l in layers]
+    if len(set(names)) != len(names):
+        raise ValueError("Layer names must be unique")
+    if 'budget' in scene:
+        unknown = [k for k in scene['budget'] if k not in budget.Budget._fields + ('min_lod',)]
+        if unknown:
+            raise ValueError("Unknown budget caps: {} (choose from {})".format(unknown, list(budget.Budget._fields)))
+    scene['layers'] = layers
+    return scene
+
+def layer_seed(scene, layer):
+    """Seed of a layer: its own, or derived from the scene seed & the layer's name (so it doesn't depend on the layer order)"""
+    if 'seed' in layer:
+        return layer['seed']
+    return (scene['seed'] + zlib.crc32(layer['name'].encode())) % 2**32
+
+def _hash(state):
+    """Hash of some JSON-able state (anything else, like a dtype, is hashed as its string)"""
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+def terrain_key(scene, layer):
+    """Cache key of a terrain layer (terrains don't depend on any other layer)"""
+    return _hash({'layer': layer, 'seed': layer_seed(scene, layer), 'size': [scene['width'], scene['height']]})
+
+def tree_arguments(kind, kwargs):
+    """All the arguments of a tree from tree_jobs (with the defaults of its drawing function filled in)"""
+    args = inspect.signature(TREE_FUNCTIONS[kind]).bind(**kwargs)
+    args.apply_defaults()
+    return args.arguments
+
+def layer_keys(scene, terrains, lod=1.0):
+    """Cache key of each layer: a hash of everything its output depends on (its spec, seed, the scene size, the keys
+    of any layers it depends on & the level of detail of Joshua trees), given the points of the terrains
+    The spec only names the presets, so tree layers hash every tree's resolved arguments (see tree_jobs), and editing
+    the presets in config.py changes their keys"""
+    keys = {l['name']: terrain_key(scene, l) for l in scene['layers'] if l['type'] == 'terrain'}
+    for layer in scene['layers']:
+        if layer['type'] == 'terrain':
+            continue
+        state = {
+            'layer': layer,
+            'seed': layer_seed(scene, layer),
+            'size': [scene['width'], scene['height']],
+            'depends': keys.get(layer.get('terrain'))
+        }
+        if layer['type'] in ('tree', 'dead_tree'):
+            jobs = tree_jobs(scene, layer, terrains)
+            state['trees'] = [[kind, tree_arguments(kind, kwargs)] for kind, kwargs in jobs]
+            if any(kind == 'random' for kind, _ in jobs):
+                state['forest'] = [config.forest_trees, config.forest_probabilities]
+        if layer['type'] == 'tree' and lod != 1:
+            state['lod'] = lod
+        keys[layer['name']] = _hash(state)
+    return [keys[l['name']] for l in scene['layers']]
+
+def terrain_points(scene, layer):
+    """Generate the (x,y) points of a terrain layer (without drawing it)"""
+    engines = {'midpoint': landscape.midpoint_displacement, 'spectral': landscape.spectral_displacement}
+    np.random.seed(layer_seed(scene, layer))
+    return engines[layer.get('engine', 'midpoint')](layer['start'], layer['end'], layer['roughness'],
+                                                    layer.get('vertical_displacement'), layer.get('num_of_iterations', 16))
+
+def _per_tree(layer, key, i, n, default=None):
+    """Argument of the i-th of n trees in a layer"""
+    value = layer.get(key, default)
+    if key in PER_TREE and isinstance(value, (list, tuple)):
+        if len(value) != n:
+            raise ValueError("Layer '{}' must have one {} per tree".format(layer['name'], key))
+        return value[i]
+    return value
+
+def _tree_kwargs(params):
+    """Tree arguments of a layer: spike parameters can be given by their name in config.py (e.g. "spikes_brown")"""
+    kwargs = dict(params)
+    for k in ('spike_forward_params', 'spike_mid_params', 'spike_back_params'):
+        if isinstance(kwargs.get(k), str):
+            kwargs[k] = getattr(config, kwargs[k])
+    return kwargs
+
+def tree_jobs(scene, layer, terrains):
+    """Trees of a tree (or dead_tree) layer as a list of (kind, kwargs), see budget.ESTIMATORS"""
+    w = scene['width']
+    kind = 'dead' if layer['type'] == 'dead_tree' else 'joshua' if layer.get('preset', 'random') != 'random' else 'random'
+    xs = layer['x'] if isinstance(layer['x'], (list, tuple)) else [layer['x']]
+    jobs = []
+    for i, x in enumerate(xs):
+        # x is a fraction of the scene width; y is absolute, or relative to the height of the terrain
+        x = x * w
+        if 'terrain' in layer:
+            t = terrains[layer['terrain']]
+            y = t[np.argmin(np.abs(t[:,0]-x)),1] + _per_tree(layer, 'offset', i, len(xs), 0)
+        else:
+            y = _per_tree(layer, 'y', i, len(xs))
+        kwargs = _tree_kwargs(layer.get('params', {}))
+        for k in ('length', 'width'):
+            if k in layer:
+                kwargs[k] = _per_tree(layer, k, i, len(xs))
+        if kind == 'joshua':
+            kwargs = dict(config.tree_types[layer['preset']], **kwargs)
+        jobs.append((kind, dict(kwargs, x1=x, y1=y, seed=layer_seed(scene, layer) + i)))
+    return jobs
+
+def draw_layer(scene, layer, terrains, lod=1.0, geometries=None):
+    """Draw one layer on the current axis (one data unit is one pixel), given the points of the terrains it may use
+    Joshua trees are drawn at the given level of detail (see budget.apply_lod), or from their already generated
+    geometries if given
+    Returns the actual usage of a tree layer (see budget.usage), or None"""
+    w, h = scene['width'], scene['height']
+    np.random.seed(layer_seed(scene, layer))
+    kind = layer['type']
+    if kind == 'sky':
+        landscape.draw_sky(w, h, colours.cmaps[layer['cmap']] if 'cmap' in layer else None)
+    elif kind == 'stars':
+        landscape.draw_stars(w, h, **{k: layer[k] for k in LAYER_TYPES['stars'] if k in layer})
+    elif kind == 'terrain':
+        # The same points as terrain_points (from the same seed)
+        landscape.draw_terrain(**{k: layer[k] for k in LAYER_TYPES['terrain'] if k in layer})
+    elif kind == 'sun':
+        center = list(layer['center']) if 'center' in layer else None
+        landscape.draw_sun(w, h, center=center, size=layer.get('size'), terrain=terrains.get(layer.get('terrain')), col=layer.get('col', [1,1,1]))
+    elif kind == 'dead_tree':
+        import matplotlib.pyplot as plt
+        n_patches = len(plt.gca().patches)
+        for _, kwargs in tree_jobs(scene, layer, terrains):
+            tree.draw_dead_tree(**kwargs)
+        # Every segment is one Rectangle patch
+        n = len(plt.gca().patches) - n_patches
+        return budget.Usage(n, 0, n, n*budget.BYTES_PER_SEGMENT)
+    else:
+        if geometries is None:
+            geometries = [budget.generate(k, kwargs) for k, kwargs in budget.apply_lod(tree_jobs(scene, layer, terrains), lod)]
+        for geometry in geometries:
+            tree.draw_geometry(geometry)
+        return budget.usage(geometries)
+
+class SceneRenderer:
+    """Renders scene specs layer by layer, caching each layer's RGBA buffer (by its key, see layer_keys) and the
+    composite of each prefix of the layers, so re-rendering a changed spec only redraws the changed layers & composites
+    from the first changed layer onwards
+    Layers can also be cached on disk (in cache_dir), so they are kept between runs
+    A scene with a budget has its trees generated & checked against it (see budget.fit_scene) before anything is
+    drawn, and may be refused (raising budget.BudgetExceeded)"""
+    def __init__(self, cache_dir=None, dpi=100):
+        self.cache_dir = cache_dir
+        self.dpi = dpi
+        self.layers = {}
+        self.terrains = {}
+        self.geometries = {}
+        self._used_geometries = set()
+        self.prefix = []
+        self.stats = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _generate(self, kind, kwargs):
+        """Geometry of a tree (see budget.generate): the full detail geometry is kept in memory, so unchanged trees
+        aren't regenerated, only thinned to their level of detail (& culled)"""
+        kwargs = dict(kwargs)
+        lod, cull = kwargs.pop('lod', 1.0), kwargs.pop('cull', False)
+        key = json.dumps([kind, kwargs], sort_keys=True, default=str)
+        if key not in self.geometries:
+            self.geometries[key] = budget.generate(kind, kwargs)
+        self._used_geometries.add(key)
+        geometry = budget.thin_geometry(self.geometries[key], lod)
+        return tree.cull_geometry(geometry) if cull else geometry
+
+    def _layer(self, scene, layer, key, terrains, lod=1.0, geometries=None):
+        """RGBA buffer (uint8) of a layer, from the cache if possible
+        Returns (buffer, whether it was drawn)"""
+        if key in self.layers:
+            return self.layers[key], False
+        path = os.path.join(self.cache_dir, key + '.npy') if self.cache_dir else None
+        if path and os.path.exists(path):
+            buf = np.load(path)
+            drawn = False
+        else:
+            buf = compositing.render_layer(lambda: draw_layer(scene, layer, terrains, lod, geometries), scene['width'], scene['height'], self.dpi)
+            # render_layer's buffer is 8 bit, so it is kept as uint8 without any loss
+            buf = np.rint(buf * 255).astype(np.uint8)
+            drawn = True
+            if path:
+                np.save(path + '.tmp.npy', buf)
+                os.replace(path + '.tmp.npy', path)
+        self.layers[key] = buf
+        return buf, drawn
+
+    def render(self, scene):
+        """Render a scene spec (as loaded by load_scene), and return the (h, w, 4) float32 RGBA image
+        self.stats records which layers were drawn, loaded from the cache, or re-composited, and with a budget, the
+        level of detail, the estimated & the actual usage of all the trees"""
+        scene = validate_scene(scene)
+        t0 = time.perf_counter()
+        # Terrain points are needed by the layers placed on them (& their keys), even when the terrain layer itself is cached
+        terrains = {}
+        for layer in scene['layers']:
+            if layer['type'] == 'terrain':
+                key = terrain_key(scene, layer)
+                if key not in self.terrains:
+                    self.terrains[key] = terrain_points(scene, layer)
+                terrains[layer['name']] = self.terrains[key]
+        keys = layer_keys(scene, terrains)
+
+        # Fit the trees within the budget (generating, but not drawing them), which may lower their level of detail
+        lod, expected, geometries = 1.0, None, {}
+        self._used_geometries = set()
+        if 'budget' in scene:
+            caps = dict(scene['budget'])
+            min_lod = caps.pop('min_lod', MIN_LOD)
+            layer_jobs = [(layer['name'], tree_jobs(scene, layer, terrains)) for layer in scene['layers'] if layer['type'] in ('tree', 'dead_tree')]
+            jobs = [job for _, js in layer_jobs for job in js]
+            _, generated, expected, actual, lod = budget.fit_scene(jobs, budget.Budget(**caps), min_lod, self._generate)
+            keys = layer_keys(scene, terrains, lod)
+            # The geometry of each tree layer, which is drawn as it is (it was checked against the budget)
+            for name, js in layer_jobs:
+                geometries[name], generated = generated[:len(js)], generated[len(js):]
+        # Only the trees of the current scene are kept in memory
+        self.geometries = {k: v for k, v in self.geometries.items() if k in self._used_geometries}
+
+        # Reuse the composite of the layers before the first changed one
+        same = 0
+        while same < min(len(keys), len(self.prefix)) and self.prefix[same][0] == keys[same]:
+            same += 1
+        prefix = self.prefix[:same]
+        drawn, cached = [], []
+        for layer, key in zip(scene['layers'][same:], keys[same:]):
+            buf, was_drawn = self._layer(scene, layer, key, terrains, lod, geometries.get(layer['name']) if layer['type'] == 'tree' else None)
+            (drawn if was_drawn else cached).append(layer['name'])
+            background = prefix[-1][1] if prefix else None
+            prefix.append((key, compositing.composite([buf.astype(np.float32) / 255], background)))
+        self.prefix = prefix
+        # Only the layers of the current scene are kept in memory
+        self.layers = {k: self.layers[k] for k in keys if k in self.layers}
+        self.terrains = {k: v for k, v in self.terrains.items() if k in keys}
+        self.stats = {
+            'drawn': drawn,
+            'cached': cached,
+            'reused': [l['name'] for l in scene['layers'][:same]],
+            'time_s': round(time.perf_counter() - t0, 3)
+        }
+        if expected is not None:
+            self.stats.update({
+                'lod': round(lod, 3),
+                'estimate': {k: int(round(v)) for k, v in expected._asdict().items()},
+                'usage': {k: int(round(v)) for k, v in actual._asdict().items()}
+            })
+        if not prefix:
+            return np.zeros((scene['height'], scene['width'], 4), dtype=np.float32)
+        return prefix[-1][1]
+
+def save_image(img, path):
+    """Save an RGBA image (as returned by SceneRenderer.render) as a PNG"""
+    import matplotlib.pyplot as plt
+    plt.imsave(path, np.clip(img, 0, 1))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a scene spec (JSON or YAML) to an image")
+    parser.add_argument('spec', help="Scene spec file")
+    parser.add_argument('out', help="Output image (PNG)")
+    parser.add_argument('--cache-dir', default=None, help="Directory in which rendered layers are cached between runs")
+    parser.add_argument('--watch', action='store_true', help="Keep running, and re-render whenever the spec changes")
+    parser.add_argument('--interval', type=float, default=0.5, help="Seconds between checks of the spec (with --watch)")
+    args = parser.parse_args(argv)
+    import matplotlib
+    matplotlib.use('Agg')
+    renderer = SceneRenderer(args.cache_dir)
+    mtime = None
+    while True:
+        if os.path.getmtime(args.spec) != mtime:
+            mtime = os.path.getmtime(args.spec)
+            try:
+                save_image(renderer.render(load_scene(args.spec)), args.out)
+                print("{}: drew {}, cached {}, reused {} ({:.2f}s)".format(args.out, renderer.stats['drawn'] or '-',
+                      renderer.stats['cached'] or '-', renderer.stats['reused'] or '-', renderer.stats['time_s']))
+                if 'lod' in renderer.stats:
+                    print("Budget: level of detail {}, estimated {}, actual {}".format(
+                          renderer.stats['lod'], renderer.stats['estimate'], renderer.stats['usage']))
+            except budget.BudgetExceeded as e:
+                print("Refused: {}".format(e))
+                if not args.watch:
+                    return 1
+            except (ValueError, TypeError, KeyError) as e:
+                print("Invalid scene: {}".format(e))
+                if not args.watch:
+                    return 1
+        if not args.watch:
+            return 0
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,292 @@
+"""
+service.py
+An asyncio service which renders Joshua Tree images on demand (seed + type + size -> PNG)
+    * requests go through a bounded queue (backpressure: a full queue is rejected straight away with 503)
+    * queued requests are sent in batches to a pool of worker processes, so matplotlib never blocks the event loop
+      (if a worker dies, e.g. out of memory, only the batches in the pool fail, and the pool is replaced)
+    * identical requests which are already in flight are coalesced, and finished images are kept in an LRU cache
+    * latency & throughput metrics are available at /metrics
+
+Endpoints (HTTP/1.1, on localhost by default, or on a Unix socket):
+    GET /tree?seed=1&type=ib&w=256&h=256   -> image/png (type is one of config.tree_types, or 'random')
+    GET /metrics                           -> application/json
+    GET /health                            -> text/plain
+
+Usage:
+    python service.py --port 8080
+    python service.py --unix /tmp/trees.sock
+"""
+
+# Standard imports
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+import urllib.parse
+import numpy as np
+
+# Self imports
+import config
+
+DPI = 100
+MAX_SIZE = 4096
+MAX_SEED = 2**32 - 1 # the largest seed np.random.seed accepts
+
+class Overloaded(Exception):
+    """Raised when the render queue is full"""
+
+def render_tree_png(seed, tree_type='random', w=256, h=256):
+    """Render a single tree, framed to fill a (w x h) pixel PNG image, and return the PNG's bytes
+    The same (seed, type) always gives the same tree as draw_joshua_tree(seed=seed, **config.tree_types[type])
+    (or draw_random_joshua_tree(seed=seed) for the 'random' type)"""
+    # Imported here, so the service process itself never needs matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import tree
+    if tree_type == 'random':
+        geometry = tree.generate_random_joshua_tree(seed=seed)
+    else:
+        geometry = tree.generate_joshua_tree(seed=seed, **config.tree_types[tree_type])
+    fig = Figure(figsize=(w/DPI, h/DPI), dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.axis('off')
+    tree.draw_geometry(geometry, ax)
+    points = np.concatenate([geometry.spikes.reshape(-1,2), geometry.segments.reshape(-1,2)])
+    tree.fit_axis(ax, list(points.min(axis=0)) + list(points.max(axis=0)), w, h)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=DPI)
+    return buf.getvalue()
+
+def render_batch(keys):
+    """Render a batch of (seed, type, w, h) keys in a worker process
+    Returns a list of (True, png) or (False, error message), one per key"""
+    results = []
+    for key in keys:
+        try:
+            results.append((True, render_tree_png(*key)))
+        except Exception as e:
+            results.append((False, '{}: {}'.format(type(e).__name__, e)))
+    return results
+
+class RenderService:
+    """Renders trees in a process pool, behind a bounded queue, request coalescing & an LRU result cache"""
+    def __init__(self, workers=None, queue_size=64, batch_size=4, cache_size=256, latency_window=1000):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.queue = None
+        self.queue_size = queue_size
+        self.pool = None
+        self.cache = collections.OrderedDict()
+        self.inflight = {}
+        self.dispatchers = []
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.counters = collections.Counter()
+        self.started = None
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.queue_size)
+        self.pool = self._new_pool()
+        self.dispatchers = [asyncio.ensure_future(self._dispatch()) for _ in range(self.workers)]
+        self.started = time.perf_counter()
+
+    def _new_pool(self):
+        # Workers are spawned (not forked), so they don't inherit the server's open sockets
+        return concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async def stop(self):
+        for d in self.dispatchers:
+            d.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions=True)
+        self.pool.shutdown(cancel_futures=True)
+
+    async def _dispatch(self):
+        """Take batches of queued requests, and render each batch in one call to the process pool"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            pool = self.pool
+            try:
+                results = await loop.run_in_executor(pool, render_batch, [key for key, _ in batch])
+            except concurrent.futures.process.BrokenProcessPool as e:
+                # A worker died (e.g. out of memory), which breaks the whole pool: the batches in it fail, and it is
+                # replaced (once, by whichever of their dispatchers gets here first) for the later batches
+                if self.pool is pool:
+                    self.counters['pool_restarts'] += 1
+                    self.pool = self._new_pool()
+                    pool.shutdown(wait=False)
+                results = [(False, '{}: {}'.format(type(e).__name__, e))] * len(batch)
+            except Exception as e:
+                results = [(False, '{}: {}'.format(type(e).__name__, e))] * len(batch)
+            for (key, future), (ok, result) in zip(batch, results):
+                if ok:
+                    self.counters['rendered'] += 1
+                    self._cache_put(key, result)
+                    future.set_result(result)
+                else:
+                    self.counters['errors'] += 1
+                    future.set_exception(RuntimeError(result))
+                del self.inflight[key]
+            self.counters['batches'] += 1
+
+    def _cache_put(self, key, png):
+        self.cache[key] = png
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def render(self, seed, tree_type='random', w=256, h=256):
+        """Render (or fetch from the cache) one tree image; raises Overloaded if the queue is full"""
+        t0 = time.perf_counter()
+        key = (int(seed), tree_type, int(w), int(h))
+        self.counters['requests'] += 1
+        try:
+            if key in self.cache:
+                self.counters['cache_hits'] += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            future = self.inflight.get(key)
+            if future is not None:
+                self.counters['coalesced'] += 1
+            else:
+                future = asyncio.get_running_loop().create_future()
+                try:
+                    self.queue.put_nowait((key, future))
+                except asyncio.QueueFull:
+                    self.counters['rejected'] += 1
+                    raise Overloaded("Render queue is full ({} requests)".format(self.queue_size))
+                self.inflight[key] = future
+            return await asyncio.shield(future)
+        finally:
+            self.latencies.append(time.perf_counter() - t0)
+
+    def metrics(self):
+        uptime = time.perf_counter() - self.started if self.started else 0.0
+        latencies = np.array(self.latencies) * 1e3
+        metrics = dict(self.counters)
+        metrics.update({
+            'uptime_s': round(uptime, 3),
+            'queued': self.queue.qsize() if self.queue else 0,
+            'inflight': len(self.inflight),
+            'cached': len(self.cache),
+            'throughput_per_s': round(self.counters['rendered'] / uptime, 3) if uptime else 0.0
+        })
+        if len(latencies):
+            for p in (50, 95, 99):
+                metrics['latency_p{}_ms'.format(p)] = round(float(np.percentile(latencies, p)), 3)
+        return metrics
+
+def parse_tree_query(query):
+    """Parse & validate the query of a /tree request: returns (seed, type, w, h)"""
+    params = urllib.parse.parse_qs(query)
+    get = lambda k, default: params.get(k, [default])[0]
+    seed = int(get('seed', 0))
+    tree_type = get('type', 'random')
+    w, h = int(get('w', 256)), int(get('h', 256))
+    if tree_type != 'random' and tree_type not in config.tree_types:
+        raise ValueError("Unknown tree type '{}'".format(tree_type))
+    if not (0 < w <= MAX_SIZE and 0 < h <= MAX_SIZE):
+        raise ValueError("Image size must be between 1 and {} pixels".format(MAX_SIZE))
+    if not 0 <= seed <= MAX_SEED:
+        raise ValueError("seed must be between 0 and {}".format(MAX_SEED))
+    return seed, tree_type, w, h
+
+async def _respond(writer, status, content_type, body):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+    head = "HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+        status, reasons[status], content_type, len(body))
+    writer.write(head.encode() + body)
+    await writer.drain()
+
+async def handle_connection(service, reader, writer):
+    """Handle one HTTP request (one request per connection)"""
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass # headers are not used
+        if len(request_line) < 2:
+            return await _respond(writer, 400, 'text/plain', b'Bad request')
+        method, target = request_line[0], urllib.parse.urlsplit(request_line[1])
+        if method != 'GET':
+            return await _respond(writer, 405, 'text/plain', b'Only GET is supported')
+        if target.path == '/health':
+            return await _respond(writer, 200, 'text/plain', b'ok')
+        if target.path == '/metrics':
+            return await _respond(writer, 200, 'application/json', json.dumps(service.metrics()).encode())
+        if target.path != '/tree':
+            return await _respond(writer, 404, 'text/plain', b'Not found')
+        try:
+            key = parse_tree_query(target.query)
+        except ValueError as e:
+            return await _respond(writer, 400, 'text/plain', str(e).encode())
+        try:
+            png = await service.render(*key)
+        except Overloaded as e:
+            return await _respond(writer, 503, 'text/plain', str(e).encode())
+        except RuntimeError as e:
+            return await _respond(writer, 500, 'text/plain', str(e).encode())
+        await _respond(writer, 200, 'image/png', png)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(service, host='127.0.0.1', port=8080, unix=None):
+    """Start the service & its HTTP server (on a Unix socket if `unix` is a path)
+    Returns the asyncio server (port=0 picks a free port, see server.sockets)"""
+    await service.start()
+    handler = lambda reader, writer: handle_connection(service, reader, writer)
+    if unix:
+        return await asyncio.start_unix_server(handler, path=unix)
+    return await asyncio.start_server(handler, host, port)
+
+async def fetch(path, host='127.0.0.1', port=8080, unix=None):
+    """Minimal HTTP GET client (e.g. for testing the service locally): returns (status, body)"""
+    if unix:
+        reader, writer = await asyncio.open_unix_connection(unix)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".format(path).encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), body
+
+async def _main(args):
+    service = RenderService(args.workers, args.queue_size, args.batch_size, args.cache_size)
+    server = await serve(service, args.host, args.port, args.unix)
+    print("Serving on {}".format(args.unix or '{}:{}'.format(*server.sockets[0].getsockname()[:2])))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render Joshua Tree images on demand")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', default=None, help="Serve on this Unix socket path instead of TCP")
+    parser.add_argument('--workers', type=int, default=None, help="Number of render processes (default: all cores)")
+    parser.add_argument('--queue-size', type=int, default=64, help="Maximum number of queued renders before rejecting requests")
+    parser.add_argument('--batch-size', type=int, default=4, help="Maximum number of renders sent to a worker at once")
+    parser.add_argument('--cache-size', type=int, default=256, help="Number of images kept in the result cache")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,330 @@
+"""
+sweep.py
+Command line tool to explore tree parameters: renders every combination of some parameter values as thumbnails
+    * any draw_joshua_tree argument (e.g. split_prob, depth, seed, darken) can be varied, and any spike parameter,
+      as back.<param>, forward.<param>, mid.<param> (or spikes.<param> for all three)
+    * the thumbnails are rendered across a pool of worker processes, and tiled into contact sheets
+    * each tree's geometry & thumbnail are cached (by a hash of their arguments) in the output folder, so re-running
+      a sweep only renders the new combinations, and e.g. changing the thumbnail size only redraws the trees
+    * index.csv & index.html list the parameters of every thumbnail, and where it is on the contact sheets
+    * combinations estimated to have more than --max-spikes spikes (see budget.py) are skipped
+
+Example:
+    python sweep.py out/ --preset ib --vary split_prob=0.7:0.95:6 --vary seed=0:4:5 --vary forward.spike_layout=regular,random
+
+Values are given as a list (a,b,c) or as start:stop:num (num evenly spaced values from start to stop, inclusive)
+"""
+
+# Standard imports
+import argparse
+import csv
+import hashlib
+import html
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+import numpy as np
+# matplotlib is only imported by the worker processes & when tiling the contact sheets
+
+# Self imports
+import budget
+import config
+import tree
+
+DPI = 100
+
+# Spike parameter groups (the prefix of a spike parameter's name) & the tree arguments they set
+SPIKE_GROUPS = {
+    'back': ['spike_back_params'],
+    'forward': ['spike_forward_params'],
+    'mid': ['spike_mid_params'],
+    'spikes': ['spike_back_params', 'spike_forward_params', 'spike_mid_params']
+}
+SPIKE_DEFAULTS = {
+    'spike_back_params': config.spikes_brown,
+    'spike_forward_params': config.spikes_green,
+    'spike_mid_params': config.spikes_yellow
+}
+
+# Tree arguments which can be varied (the position, dtype & whole spike dicts can't)
+TREE_ARGS = [k for k in inspect.signature(tree.draw_joshua_tree).parameters if k not in ['x1', 'y1', 'dtype'] + list(SPIKE_DEFAULTS)]
+
+def parse_value(text):
+    """A single parameter value: a number, bool, list (e.g. a colour) or null as JSON, otherwise a string"""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def split_values(text):
+    """Split a list of values on the commas which aren't inside brackets, so JSON lists (e.g. colours such as
+    [0.5,0.5,0.5]) stay whole"""
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(text):
+        if c in '[{':
+            depth += 1
+        elif c in ']}':
+            depth -= 1
+            if depth < 0:
+                raise ValueError("Unbalanced '{}' in '{}'".format(c, text))
+        elif c == ',' and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    if depth:
+        raise ValueError("Unclosed bracket in '{}'".format(text))
+    parts.append(text[start:])
+    for part in parts:
+        if part.strip()[:1] in ('[', '{') and isinstance(parse_value(part), str):
+            raise ValueError("Invalid JSON value '{}'".format(part))
+    return parts
+
+def parse_vary(item):
+    """Parse a parameter range such as 'split_prob=0.7:0.95:6', 'spike_layout=regular,random' or
+    'spikes.spike_colour=[0.5,0.5,0.5],[0.2,0.3,0.4]' into (name, values)"""
+    name, _, values = item.partition('=')
+    name = name.strip()
+    group, _, param = name.rpartition('.')
+    if group:
+        if group not in SPIKE_GROUPS or param not in config.spike_param_names:
+            raise ValueError("Unknown spike parameter '{}' (use one of {}.<param>, with <param> one of {})".format(
+                name, '/'.join(SPIKE_GROUPS), ', '.join(config.spike_param_names)))
+    elif name not in TREE_ARGS:
+        raise ValueError("Unknown tree parameter '{}' (choose from {})".format(name, ', '.join(TREE_ARGS)))
+    if not values:
+        raise ValueError("No values given for '{}'".format(name))
+    parts = values.split(':')
+    if len(parts) == 3 and not values.lstrip().startswith(('[', '{')):
+        start, stop, num = parse_value(parts[0]), parse_value(parts[1]), int(parts[2])
+        values = np.linspace(start, stop, num)
+        # Integer ranges (e.g. seed=0:9:10) stay integers
+        if isinstance(start, int) and isinstance(stop, int) and np.all(values == np.round(values)):
+            return name, [int(v) for v in values]
+        return name, [round(float(v), 10) for v in values]
+    return name, [parse_value(v) for v in split_values(values)]
+
+def tree_kwargs(preset, params):
+    """draw_joshua_tree arguments of one combination of parameters (on top of a preset from config.tree_types)"""
+    kwargs = dict(config.tree_types[preset])
+    kwargs.update({k: dict(v) for k, v in SPIKE_DEFAULTS.items()})
+    for name, value in params.items():
+        group, _, param = name.rpartition('.')
+        if group:
+            for k in SPIKE_GROUPS[group]:
+                kwargs[k][param] = value
+        else:
+            kwargs[name] = value
+    kwargs.setdefault('seed', 0)
+    return kwargs
+
+def cache_key(kwargs):
+    """Hash of some draw_joshua_tree (or generate_joshua_tree) arguments, with the defaults filled in, so the same
+    tree has the same key whether or not an argument is given explicitly"""
+    args = inspect.signature(tree.draw_joshua_tree).bind(**kwargs)
+    args.apply_defaults()
+    return hashlib.sha256(json.dumps(args.arguments, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+def split_kwargs(kwargs):
+    """Split draw_joshua_tree arguments into those of generate_joshua_tree (which set the geometry) & cull"""
+    kwargs = dict(kwargs)
+    return kwargs, kwargs.pop('cull', False)
+
+def load_geometry(out_dir, kwargs):
+    """Geometry of a tree, from the cache in out_dir if it has been generated before"""
+    path = os.path.join(out_dir, 'geometry', cache_key(kwargs) + '.pkl')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    geometry = tree.generate_joshua_tree(**kwargs)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(geometry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+    return geometry
+
+def render_cells(job):
+    """Render the thumbnails of some cells (image path, kwargs) in a worker process, reusing one figure
+    Cells with the same geometry should be in the same job, so it is only loaded once
+    Returns a list of (image path, number of segments, number of spikes), one per cell"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    out_dir, cells, size = job
+    fig = Figure(figsize=(size/DPI, size/DPI), dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.axis('off')
+    results = []
+    geometry, geometry_kwargs = None, None
+    for image, kwargs in cells:
+        kwargs, cull = split_kwargs(kwargs)
+        if kwargs != geometry_kwargs:
+            geometry, geometry_kwargs = load_geometry(out_dir, kwargs), kwargs
+        points = np.concatenate([geometry.spikes.reshape(-1,2), geometry.segments.reshape(-1,2)]).astype(float)
+        tree.fit_axis(ax, list(points.min(axis=0)) + list(points.max(axis=0)), size, size)
+        # Culled at the size the tree is drawn in the thumbnail
+        drawn = tree.cull_geometry(geometry, tree.drawn_size(geometry, ax)) if cull else geometry
+        # Removing the previous tree is much quicker than clearing the figure (& making a new axis) every time
+        for collection in list(ax.collections):
+            collection.remove()
+        tree.draw_geometry(drawn, ax)
+        path = os.path.join(out_dir, image)
+        fig.savefig(path + '.tmp.png', dpi=DPI)
+        os.replace(path + '.tmp.png', path)
+        results.append((image, len(geometry.segments), len(drawn.spikes)))
+    return results
+
+def tile(images, columns, gap=2):
+    """Tile some (equally sized) RGB(A) images into one contact sheet, row by row, on a white background"""
+    h, w = images[0].shape[:2]
+    rows = int(np.ceil(len(images) / columns))
+    sheet = np.ones((rows*(h+gap)+gap, columns*(w+gap)+gap, 3), dtype=np.float32)
+    for i, img in enumerate(images):
+        r, c = divmod(i, columns)
+        sheet[gap+r*(h+gap):gap+r*(h+gap)+h, gap+c*(w+gap):gap+c*(w+gap)+w] = img[:,:,:3]
+    return sheet
+
+def caption(params):
+    return ', '.join('{}={}'.format(k, v) for k, v in params.items())
+
+def write_index(out_dir, rows, varied):
+    """Write index.csv & index.html, listing every thumbnail's parameters, sheet & position on it"""
+    fields = ['image', 'sheet', 'row', 'column'] + varied + ['segments', 'spikes', 'status']
+    with open(os.path.join(out_dir, 'index.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: json.dumps(v) if isinstance(v, (list, dict)) else v for k, v in row.items()})
+    lines = ['<!DOCTYPE html>', '<meta charset="utf-8">', '<title>Parameter sweep</title>',
+             '<style>body{font-family:sans-serif} figure{display:inline-block;margin:4px;width:min-content} '
+             'figcaption{font-size:11px;word-break:break-all}</style>']
+    for sheet in sorted(set(r['sheet'] for r in rows)):
+        lines.append('<h2><a href="{0}">{0}</a></h2>'.format(html.escape(sheet)))
+        row_number = None
+        for row in (r for r in rows if r['sheet'] == sheet):
+            if row['row'] != row_number:
+                if row_number is not None:
+                    lines.append('</div>')
+                lines.append('<div>')
+                row_number = row['row']
+            label = caption({k: row[k] for k in varied})
+            if row['status'] == 'ok':
+                label += ' ({} spikes)'.format(row['spikes'])
+            else:
+                label += ' ({})'.format(row['status'])
+            lines.append('<figure><img src="{}" title="{}"><figcaption>{}</figcaption></figure>'.format(
+                html.escape(row['image']), html.escape(label), html.escape(label)))
+        lines.append('</div>')
+    with open(os.path.join(out_dir, 'index.html'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def sweep(out_dir, vary, preset='i', size=128, columns=None, sheet_rows=10, max_spikes=200000, workers=None, verbose=True):
+    """Render every combination of the (name, values) parameter ranges as thumbnails in out_dir, tiled into contact
+    sheets (one row per value of all but the last parameter, unless columns is given), with an index of the parameters
+    Thumbnails which have already been rendered (with the same arguments & size) are reused
+    Returns the rows of the index (one dict per thumbnail)"""
+    if preset not in config.tree_types:
+        raise ValueError("Unknown tree type '{}' (choose from {})".format(preset, ', '.join(config.tree_types)))
+    names = [name for name, _ in vary]
+    if len(set(names)) != len(names):
+        raise ValueError("Each parameter can only be varied once")
+    for sub in ('thumbs', 'geometry'):
+        os.makedirs(os.path.join(out_dir, sub), exist_ok=True)
+    varied = [name for name, values in vary if len(values) > 1]
+    columns = columns or (len(vary[-1][1]) if vary else 1)
+    t0 = time.perf_counter()
+
+    # Every combination, with the image it is rendered to (named by a hash of its arguments & the size)
+    rows, todo = [], {}
+    for i, values in enumerate(itertools.product(*[values for _, values in vary])):
+        params = dict(zip(names, values))
+        kwargs = tree_kwargs(preset, params)
+        image = os.path.join('thumbs', '{}-{}.png'.format(cache_key(kwargs), size))
+        row = dict({k: params[k] for k in varied}, image=image, segments='', spikes='', status='ok')
+        row['sheet'] = 'sheet-{:03d}.png'.format(i // (columns*sheet_rows))
+        row['row'], row['column'] = divmod(i % (columns*sheet_rows), columns)
+        estimate = budget.estimate_joshua_tree(**kwargs)
+        if max_spikes is not None and estimate.spikes > max_spikes:
+            row['status'] = 'skipped (~{:.0f} spikes)'.format(estimate.spikes)
+        elif not os.path.exists(os.path.join(out_dir, image)):
+            todo[image] = kwargs
+        rows.append(row)
+
+    # Render the new thumbnails, with the cells sharing a geometry (differing only in cull) in the same job
+    cells = sorted(todo.items(), key=lambda cell: cache_key(split_kwargs(cell[1])[0]))
+    workers = workers or os.cpu_count() or 1
+    jobs, job = [], []
+    for i, cell in enumerate(cells):
+        same_geometry = job and split_kwargs(cell[1])[0] == split_kwargs(job[-1][1])[0]
+        if job and not same_geometry and len(job) >= max(1, len(cells) // (4*workers)):
+            jobs.append((out_dir, job, size))
+            job = []
+        job.append(cell)
+    if job:
+        jobs.append((out_dir, job, size))
+    # Segment & spike counts of every thumbnail rendered so far (so they are still known when it is cached)
+    counts_path = os.path.join(out_dir, 'thumbs', 'counts.json')
+    counts = {}
+    if os.path.exists(counts_path):
+        with open(counts_path) as f:
+            counts = json.load(f)
+    if jobs:
+        with multiprocessing.Pool(min(workers, len(jobs))) as pool:
+            done = 0
+            for results in pool.imap_unordered(render_cells, jobs):
+                counts.update({image: (segments, spikes) for image, segments, spikes in results})
+                done += len(results)
+                if verbose:
+                    print("Rendered {}/{} thumbnails".format(done, len(cells)), end='\r')
+        if verbose:
+            print()
+        with open(counts_path + '.tmp', 'w') as f:
+            json.dump(counts, f)
+        os.replace(counts_path + '.tmp', counts_path)
+
+    # Tile the contact sheets (skipped cells are left blank)
+    import matplotlib.pyplot as plt
+    blank = np.ones((size, size, 3), dtype=np.float32)
+    for sheet in sorted(set(r['sheet'] for r in rows)):
+        images = []
+        for row in (r for r in rows if r['sheet'] == sheet):
+            if row['status'] == 'ok':
+                images.append(plt.imread(os.path.join(out_dir, row['image'])))
+            else:
+                images.append(blank)
+        plt.imsave(os.path.join(out_dir, sheet), tile(images, columns))
+    for row in rows:
+        if row['image'] in counts:
+            row['segments'], row['spikes'] = counts[row['image']]
+    write_index(out_dir, rows, varied)
+    if verbose:
+        print("{} thumbnails ({} rendered, {} cached, {} skipped) on {} sheets in {:.1f}s".format(
+            len(rows), len(cells), sum(r['status'] == 'ok' for r in rows) - len(cells),
+            sum(r['status'] != 'ok' for r in rows), len(set(r['sheet'] for r in rows)), time.perf_counter() - t0))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render thumbnails of every combination of some tree parameters")
+    parser.add_argument('out_dir', help="Output folder (contact sheets, index.csv, index.html & the caches)")
+    parser.add_argument('--vary', action='append', default=[], metavar='NAME=VALUES',
+                        help="Parameter values, e.g. split_prob=0.7:0.95:6 (start:stop:num), back.spike_layout=regular,random "
+                             "or spikes.spike_colour=[0.5,0.5,0.5],[0.2,0.3,0.4]")
+    parser.add_argument('--preset', default='i', help="Tree type the parameters are changed from (default: i)")
+    parser.add_argument('--size', type=int, default=128, help="Thumbnail size in pixels")
+    parser.add_argument('--columns', type=int, default=None, help="Thumbnails per row (default: the number of values of the last parameter)")
+    parser.add_argument('--sheet-rows', type=int, default=10, help="Rows per contact sheet")
+    parser.add_argument('--max-spikes', type=float, default=200000, help="Skip combinations with more (estimated) spikes than this")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+    try:
+        vary = [parse_vary(item) for item in args.vary]
+        sweep(args.out_dir, vary, args.preset, args.size, args.columns, args.sheet_rows, args.max_spikes, args.workers)
+    except (ValueError, TypeError) as e:
+        print("Invalid sweep: {}".format(e))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
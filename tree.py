@@ -4,19 +4,49 @@ Contains the functions to draw:
     * simple line tree (the classic "dead tree" look)
     * joshua trees (tree generation, texture generation)
 
+Joshua trees are generated in two steps: the recursion only records the branch segments & draws the random numbers
+for each set of spikes, then all spike triangles in the tree are built & rotated in one batched (numpy) step.
+The resulting geometry (see TreeGeometry) can then be drawn with draw_geometry.
 """
 
 # Standard imports
+import collections
+import functools
 import numpy as np
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
-from matplotlib.collections import PatchCollection
+# matplotlib is only imported inside the drawing functions, so the tree generation can be imported (& run) without it
 
 # Self imports
 import colours
 import config
 
+# Everything about a tree's appearance which stays fixed through the recursion
+_TreeStyle = collections.namedtuple('_TreeStyle', ['col', 'draw_rect', 'draw_texture', 'spikes', 'spike_colours'])
+
+# The random numbers & placement of one set of spikes (on one branch), recorded during the recursion
+_SpikeRecord = collections.namedtuple('_SpikeRecord', [
+    'layer', 'zorder', 'pivot_x', 'pivot_y', 'rotation', 'x1', 'y1', 'width', 'length', 'spikes', 'colour', 'unit', 'rnd'
+])
+
+# Culling (see cull_geometry): the largest drawn size (in pixels) of a tree which is culled, and the points of the
+# coverage raster per pixel (at one per pixel, antialiased edges can still show through the gaps)
+MAX_CULL_PIXELS = 4096
+CULL_POINTS_PER_PIXEL = 1.5
+
+# The full geometry of a Joshua Tree, with everything in drawing order (by zorder, then by order of generation)
+TreeGeometry = collections.namedtuple('TreeGeometry', [
+    'segments',        # (m,2,2) start & end points of each branch segment
+    'segment_widths',  # (m,) width of each branch segment
+    'segment_zorders', # (m,) zorder of each branch segment
+    'rect_colour',     # colour of the rectangular branch segments
+    'rects',           # (k,4,2) rectangular branch segments (k=m if draw_rect, otherwise k=0)
+    'rect_zorders',    # (k,) zorder of each rectangular segment
+    'spikes',          # (n,3,2) vertices of every spike triangle
+    'spike_colours',   # (n,3) RGB face colour of each spike (0-1 floats, or 0-255 uint8 for float32 geometry)
+    'spike_layers',    # (n,) which spikes each triangle belongs to: 0=back (brown), 1=forward (green), 2=mid (yellow)
+    'spike_zorders',   # (n,) zorder of each spike
+    'spike_params'     # compiled parameters (config.SpikeParams) of the back, forward & mid spikes
+])
+
 def draw_random_joshua_tree(
                             x1=0,
                             y1=0,
@@ -29,25 +59,40 @@ def draw_random_joshua_tree(
                             spike_forward_params=config.spikes_green,
                             spike_mid_params=config.spikes_yellow,
                             spike_back_params=config.spikes_brown,
-                            seed=None
+                            seed=None,
+                            dtype=np.float64,
+                            cull=False
                             ):
+    """Draws a Joshua Tree of a random type (selected with config.forest_probabilities) on the current axis
+    Passing cull=True skips the spikes & rectangles which are hidden at the axis' current size (see draw_joshua_tree)
+    Returns the number of branch segments drawn"""
+    geometry = generate_random_joshua_tree(x1, y1, length, col, draw_rect, draw_texture, darken, zorder,
+                                           spike_forward_params, spike_mid_params, spike_back_params, seed, dtype)
+    _draw_culled(geometry, cull)
+    return len(geometry.segments)
+
+def generate_random_joshua_tree(
+                                x1=0,
+                                y1=0,
+                                length=10,
+                                col=colours.cols['brown'],
+                                draw_rect=False,
+                                draw_texture=[True,True,True],
+                                darken=None,
+                                zorder=4,
+                                spike_forward_params=config.spikes_green,
+                                spike_mid_params=config.spikes_yellow,
+                                spike_back_params=config.spikes_brown,
+                                seed=None,
+                                dtype=np.float64
+                                ):
+    """Generates the geometry of a Joshua Tree of a random type, without drawing it (see draw_random_joshua_tree)"""
     if seed is not None:
         np.random.seed(seed)
-    rnd_params = np.random.choice(config.forest_trees, p=config.forest_probabilities)
-    draw_joshua_tree(
-        x1=x1,
-        y1=y1,
-        length=length,
-        col=col,
-        draw_rect=draw_rect,
-        draw_texture=draw_texture,
-        darken=darken,
-        zorder=zorder,
-        spike_forward_params=spike_forward_params,
-        spike_mid_params=spike_mid_params,
-        spike_back_params=spike_back_params,
-        **rnd_params
-        )
+    rnd_idx = np.random.choice(len(config.compiled_forest_trees), p=config.forest_probabilities)
+    params = config.compiled_forest_trees[rnd_idx]
+    style = _tree_style(col, draw_rect, draw_texture, darken, spike_forward_params, spike_mid_params, spike_back_params)
+    return _generate_joshua_tree(x1, y1, length, length*params.length_width, zorder, params, style, dtype)
 
 def draw_joshua_tree(
                     x1=0,
@@ -76,133 +121,494 @@ def draw_joshua_tree(
                     spike_mid_params=config.spikes_yellow,
                     spike_back_params=config.spikes_brown,
                     seed=None,
+                    dtype=np.float64,
+                    cull=False
                     ):
+    """Draws a Joshua Tree on the current axis
+    Passing cull=True skips the spikes & rectangles which are hidden behind later ones at the size the tree is drawn
+    in pixels (see cull_geometry), so the axis limits & figure size should already be set
+    Returns the number of branch segments drawn"""
+    geometry = generate_joshua_tree(
+        x1=x1,
+        y1=y1,
+        length=length,
+        length_change=length_change,
+        length_vary_prop=length_vary_prop,
+        length_width=length_width,
+        width=width,
+        width_change=width_change,
+        angle=angle,
+        angle_change=angle_change,
+        angle_vary_prop=angle_vary_prop,
+        large_angle_prob=large_angle_prob,
+        large_angle=large_angle,
+        split_prob=split_prob,
+        split_prob_change=split_prob_change,
+        depth=depth,
+        max_depth=max_depth,
+        col=col,
+        draw_rect=draw_rect,
+        draw_texture=draw_texture,
+        darken=darken,
+        zorder=zorder,
+        spike_forward_params=spike_forward_params,
+        spike_mid_params=spike_mid_params,
+        spike_back_params=spike_back_params,
+        seed=seed,
+        dtype=dtype)
+    _draw_culled(geometry, cull)
+    return len(geometry.segments)
+
+def generate_joshua_tree(
+                        x1=0,
+                        y1=0,
+                        length=10,
+                        length_change=0.8,
+                        length_vary_prop=0.2,
+                        length_width=0.2,
+                        width=None,
+                        width_change=0.9,
+                        angle=-90,
+                        angle_change=30,
+                        angle_vary_prop=0.4,
+                        large_angle_prob=0.0,
+                        large_angle=60, 
+                        split_prob=0.9,
+                        split_prob_change=1.0,
+                        depth=6,
+                        max_depth=6,
+                        col=colours.cols['brown'],
+                        draw_rect=False,
+                        draw_texture=[True,True,True],
+                        darken=None,
+                        zorder=4,
+                        spike_forward_params=config.spikes_green,
+                        spike_mid_params=config.spikes_yellow,
+                        spike_back_params=config.spikes_brown,
+                        seed=None,
+                        dtype=np.float64,
+                        ):
+    """Generates the geometry of a Joshua Tree, without drawing it (see draw_joshua_tree)
+    The parameters are validated & compiled once (see config.compile_tree) before the recursion starts
+    Passing dtype=np.float32 gives the memory-lean geometry (float32 vertices, uint8 colours)
+    Returns a TreeGeometry"""
     if seed is not None:
         np.random.seed(seed)
-    if depth:
-        zorder += 1
-        # Calculatre end position of segment
-        x2 = x1 + np.cos(np.radians(angle)) * length
-        y2 = y1 - np.sin(np.radians(angle)) * length
-        
-        # Set the width
-        if width is None:
-            width = length * length_width
-
-        # Draw baseline rectanglular segment
-        if draw_rect:
-            dcol = col
-            if darken is not None:
-                dcol = colours.darken(col, darken)
-            rect = Rectangle((x1-(width/2), y1), width, length, color=dcol, zorder=zorder)
-            t = mpl.transforms.Affine2D().rotate_deg_around(x1,y1,-angle-90) + plt.gca().transData
-            rect.set_transform(t)
-            plt.gca().add_patch(rect)
-        
-        #density = 2 + (2 * (1-(depth / max_depth)))
-        #max_angle = 40 * (1-(depth / max_depth))
-        #TODO: Add depth-varying density and angles
-        if draw_texture[0]:
-            spikes0 = draw_spikes(x1, y1+(length*0.25), width, length*0.75, spike_zorder=zorder, darken=darken, **spike_back_params)
-            t0 = mpl.transforms.Affine2D().rotate_deg_around(x1,y1,-angle-90) + plt.gca().transData
-            spikes0.set_transform(t0)
-            plt.gca().add_collection(spikes0)
-            
-        # Randomise the angle & length changes
-        rnd1 = np.random.random(4) - 0.5
-        l1 = length_change + (rnd1[0] * length_change * length_vary_prop)
-        l2 = length_change + (rnd1[1] * length_change * length_vary_prop)
-        a1 = angle_change  + (rnd1[2] * angle_change  * angle_vary_prop)
-        a2 = angle_change  + (rnd1[3] * angle_change  * angle_vary_prop)
-        
-        # Reduce split probability
-        split_prob  = split_prob * split_prob_change
-        
-        # Add large angle split
-        rnd2 = np.random.random(4)
-        if rnd2[0] < large_angle_prob: a1 = large_angle * rnd2[1]/np.abs(rnd2[1]) 
-        if rnd2[2] < large_angle_prob: a2 = large_angle * rnd2[3]/np.abs(rnd2[3])
+    params = config.compile_tree({
+        'length_change': length_change,
+        'length_vary_prop': length_vary_prop,
+        'length_width': length_width,
+        'width_change': width_change,
+        'angle': angle,
+        'angle_change': angle_change,
+        'angle_vary_prop': angle_vary_prop,
+        'large_angle_prob': large_angle_prob,
+        'large_angle': large_angle,
+        'split_prob': split_prob,
+        'split_prob_change': split_prob_change,
+        'depth': depth,
+        'max_depth': max_depth
+    })
+    style = _tree_style(col, draw_rect, draw_texture, darken, spike_forward_params, spike_mid_params, spike_back_params)
+    # Set the width
+    if width is None:
+        width = length * length_width
+    return _generate_joshua_tree(x1, y1, length, width, zorder, params, style, dtype)
 
-        # Draw two more branches
-        rnd3 = np.random.random(2)
-        if rnd3[0] < split_prob: draw_joshua_tree(
-            x1=x2,
-            y1=y2,
-            angle=angle-a1,
-            length=length*l1,
-            width=width*width_change,
-            depth=depth-1,
-            # Everything else as is
-            length_change=length_change,
-            length_vary_prop=length_vary_prop,
-            length_width=length_width,
-            width_change=width_change,
-            angle_change=angle_change,
-            angle_vary_prop=angle_vary_prop,
-            large_angle_prob=large_angle_prob,
-            large_angle=large_angle, 
-            split_prob=split_prob,
-            split_prob_change=split_prob_change,
-            max_depth=max_depth,
-            col=col,
-            draw_rect=draw_rect,
-            draw_texture=draw_texture,
-            zorder=zorder,
-            spike_forward_params=spike_forward_params,
-            spike_mid_params=spike_mid_params,
-            spike_back_params=spike_back_params,
-            darken=darken,
-            # Seed should not be used again
-            seed=None
-            )
-        if rnd3[1] < split_prob: draw_joshua_tree(
-            x1=x2,
-            y1=y2,
-            angle=angle+a2,
-            length=length*l2,
-            width=width*width_change,
-            depth=depth-1,
-            # Everything else as is
-            length_change=length_change,
-            length_vary_prop=length_vary_prop,
-            length_width=length_width,
-            width_change=width_change,
-            angle_change=angle_change,
-            angle_vary_prop=angle_vary_prop,
-            large_angle_prob=large_angle_prob,
-            large_angle=large_angle, 
-            split_prob=split_prob,
-            split_prob_change=split_prob_change,
-            max_depth=max_depth,
-            col=col,
-            draw_rect=draw_rect,
-            draw_texture=draw_texture,
-            zorder=zorder,
-            spike_forward_params=spike_forward_params,
-            spike_mid_params=spike_mid_params,
-            spike_back_params=spike_back_params,
-            darken=darken,
-            # Seed should not be used again
-            seed=None
-            )
-
-        # Draw leaves at terminal branches
-        if (rnd3[0] > split_prob and rnd3[1] > split_prob) or depth==1:
-            # At a terminal branch, draw the leaves
-            # This is set at the same angle as the preceding branch (to avoid spikes at weird angles)
-            # Green
-            # TODO: think about adding back in max(length,init_length/4) so the green spikes don't get tiny at higher depths
-            if draw_texture[1]:
-                spikes1 = draw_spikes(x2, y2, width, length, spike_zorder=zorder, darken=darken, **spike_forward_params)
-                t1 = mpl.transforms.Affine2D().rotate_deg_around(x2,y2,-angle-90) + plt.gca().transData
-                spikes1.set_transform(t1)
-                plt.gca().add_collection(spikes1)
-            
-            if draw_texture[2]:
-                spikes2 = draw_spikes(x2, y2-(length*0.25), width, length*0.25, spike_zorder=zorder, darken=darken, **spike_mid_params)
-                t2 = mpl.transforms.Affine2D().rotate_deg_around(x2,y2,-angle-90) + plt.gca().transData
-                spikes2.set_transform(t2)
-                plt.gca().add_collection(spikes2) 
+def _tree_style(col, draw_rect, draw_texture, darken, spike_forward_params, spike_mid_params, spike_back_params):
+    """Compile the spike parameters, and darken all the colours once for the whole tree"""
+    # Spikes are stored in the same order as draw_texture: back (brown), forward (green), mid (yellow)
+    spikes = (config.compile_spikes(spike_back_params),
+              config.compile_spikes(spike_forward_params),
+              config.compile_spikes(spike_mid_params))
+    spike_colours = [s.spike_colour for s in spikes]
+    if darken is not None:
+        col = colours.darken(col, darken)
+        spike_colours = [colours.darken(c, darken) for c in spike_colours]
+    return _TreeStyle(col, draw_rect, tuple(draw_texture), spikes, tuple(spike_colours))
+
+def _generate_joshua_tree(x1, y1, length, width, zorder, params, style, dtype=np.float64):
+    """Run the recursion, then build the geometry of all the segments & spikes in drawing order"""
+    lean = np.dtype(dtype) != np.float64
+    segments, records = [], []
+    _grow_joshua_tree(x1, y1, length, width, params.angle_rad, params.depth, zorder, params, style, segments, records)
+
+    # Segments: [x1, y1, x2, y2, width, length, rotation, zorder]
+    seg = np.array(segments, dtype=float).reshape(-1, 8)
+    seg = seg[np.argsort(seg[:,7], kind='stable')]
+    rects = np.empty((0,4,2), dtype=dtype)
+    if style.draw_rect:
+        # Rectangle corners before rotation: (x1-w/2, y1), (x1+w/2, y1), (x1+w/2, y1+l), (x1-w/2, y1+l)
+        half, zero = seg[:,4]/2, np.zeros(len(seg))
+        corners = np.empty((len(seg),4,2))
+        corners[:,:,0] = seg[:,0:1] + np.stack([-half, half, half, -half], axis=1)
+        corners[:,:,1] = seg[:,1:2] + np.stack([zero, zero, seg[:,5], seg[:,5]], axis=1)
+        rects = _rotate(corners, seg[:,0], seg[:,1], np.cos(seg[:,6]), np.sin(seg[:,6])).astype(dtype, copy=False)
+
+    # Spikes are drawn in zorder, and within the same zorder, in the order they were generated
+    records = sorted(records, key=lambda r: r.zorder)
+    verts, cols = _spike_geometry(records, dtype)
+    if lean:
+        cols = _to_uint8(cols)
+    counts = [len(r.unit) for r in records]
+    zorder_dtype = np.int16 if lean else int
+    return TreeGeometry(
+        segments=seg[:,0:4].reshape(-1,2,2).astype(dtype, copy=False),
+        segment_widths=seg[:,4].astype(dtype, copy=False),
+        segment_zorders=seg[:,7].astype(zorder_dtype),
+        rect_colour=style.col,
+        rects=rects,
+        rect_zorders=seg[:len(rects),7].astype(zorder_dtype),
+        spikes=verts,
+        spike_colours=cols,
+        spike_layers=np.repeat(np.array([r.layer for r in records], dtype=np.int8), counts),
+        spike_zorders=np.repeat(np.array([r.zorder for r in records], dtype=zorder_dtype), counts),
+        spike_params=style.spikes)
+
+def _to_uint8(cols):
+    """Convert 0-1 colours to uint8 (0-255)"""
+    cols *= 255
+    return np.rint(cols, out=cols).astype(np.uint8)
+
+def _grow_joshua_tree(x1, y1, length, width, angle, depth, zorder, params, style, segments, records):
+    """Recursive part of the Joshua Tree generation: angles are in radians & parameters are compiled (config.TreeParams)
+    Segments & spike records are appended to the given lists; returns the number of segments"""
+    if not depth:
+        return 0
+    zorder += 1
+    # Calculatre end position of segment
+    x2 = x1 + np.cos(angle) * length
+    y2 = y1 - np.sin(angle) * length
+    # Rotation of the segment (straight up is -90 degrees)
+    rotation = -angle - (np.pi/2)
+    segments.append((x1, y1, x2, y2, width, length, rotation, zorder))
+
+    #TODO: Add depth-varying density and angles
+    if style.draw_texture[0]:
+        records.append(_spike_record(0, zorder, x1, y1, rotation, x1, y1+(length*0.25), width, length*0.75, style))
+
+    # Randomise the angle & length changes
+    rnd1 = np.random.random(4) - 0.5
+    l1 = params.length_change + (rnd1[0] * params.length_change * params.length_vary_prop)
+    l2 = params.length_change + (rnd1[1] * params.length_change * params.length_vary_prop)
+    a1 = params.angle_change_rad + (rnd1[2] * params.angle_change_rad * params.angle_vary_prop)
+    a2 = params.angle_change_rad + (rnd1[3] * params.angle_change_rad * params.angle_vary_prop)
+
+    # Split probability (already reduced for this depth)
+    split_prob = params.split_probs[depth]
+
+    # Add large angle split
+    rnd2 = np.random.random(4)
+    if rnd2[0] < params.large_angle_prob: a1 = params.large_angle_rad * rnd2[1]/np.abs(rnd2[1])
+    if rnd2[2] < params.large_angle_prob: a2 = params.large_angle_rad * rnd2[3]/np.abs(rnd2[3])
+
+    # Grow two more branches (keeping count of the segments)
+    n_segments = 1
+    rnd3 = np.random.random(2)
+    if rnd3[0] < split_prob:
+        n_segments += _grow_joshua_tree(x2, y2, length*l1, width*params.width_change, angle-a1, depth-1, zorder, params, style, segments, records)
+    if rnd3[1] < split_prob:
+        n_segments += _grow_joshua_tree(x2, y2, length*l2, width*params.width_change, angle+a2, depth-1, zorder, params, style, segments, records)
+
+    # Add leaves at terminal branches
+    if (rnd3[0] > split_prob and rnd3[1] > split_prob) or depth==1:
+        # At a terminal branch, add the leaves
+        # This is set at the same angle as the preceding branch (to avoid spikes at weird angles)
+        # Green
+        # TODO: think about adding back in max(length,init_length/4) so the green spikes don't get tiny at higher depths
+        if style.draw_texture[1]:
+            records.append(_spike_record(1, zorder, x2, y2, rotation, x2, y2, width, length, style))
+        if style.draw_texture[2]:
+            records.append(_spike_record(2, zorder, x2, y2, rotation, x2, y2-(length*0.25), width, length*0.25, style))
+
+    return n_segments
+
+@functools.lru_cache(maxsize=None)
+def _spike_template(nx, ny, direction):
+    """Unit (0-1) grid of spike base positions for the 'regular' layout, along with the order they are drawn in
+    This only depends on the grid size, so it is computed once & reused (scaled) for every branch"""
+    posx, posy = np.meshgrid(np.linspace(0,1,nx), np.linspace(0,1,ny))
+    unit = np.vstack([posx.reshape(-1), posy.reshape(-1)]).T
+    # Sort them so they draw in the correct order (from the base upwards)
+    order = np.argsort(unit[:,1])[::-1*direction]
+    unit = unit[order]
+    unit.flags.writeable = False
+    order.flags.writeable = False
+    return unit, order
+
+def _spike_record(layer, zorder, pivot_x, pivot_y, rotation, x1, y1, width, length, style):
+    """Draw all the random numbers for one set of spikes (in the same order as the original per-branch algorithm)
+    Spikes are placed on the (width x length) rectangle with lower-mid point (x1, y1), then rotated around the pivot"""
+    spikes = style.spikes[layer]
+    # Random
+    if spikes.spike_layout == 'random':
+        n = int((width*length) / (0.5*spikes.spike_width*width*spikes.spike_length*width) * spikes.spike_density_rnd)
+        rnd = np.random.random(9*n)
+        unit = rnd[:2*n].reshape(n,2)
+        rnd = rnd[2*n:]
+        order = np.argsort(unit[:,1])[::-1*spikes.spike_direction]
+        unit = unit[order]
+    # Regular
+    elif spikes.spike_layout == 'regular':
+        ny = int(np.ceil((1 / (spikes.spike_length*width/length)) * spikes.spike_density_y))
+        n = spikes.nx*ny
+        unit, order = _spike_template(spikes.nx, ny, spikes.spike_direction)
+        rnd = np.random.random(7*n)
+    # Four jitters (x1, x2, x3, y3) follow the spike order; the colours do not
+    jitter = rnd[:4*n].reshape(4,n)[:,order]
+    rnd = np.concatenate([jitter.reshape(-1), rnd[4*n:]])
+    return _SpikeRecord(layer, zorder, pivot_x, pivot_y, rotation, x1, y1, width, length, spikes, style.spike_colours[layer], unit, rnd)
+
+def _rotate(verts, pivot_x, pivot_y, cos, sin):
+    """Rotate an (n,k,2) array of vertices (in place) by per-polygon angles around per-polygon pivots"""
+    px, py, c, s = pivot_x[:,None], pivot_y[:,None], cos[:,None], sin[:,None]
+    dx = verts[:,:,0] - px
+    dy = verts[:,:,1] - py
+    x, y = verts[:,:,0], verts[:,:,1]
+    # x = (c*dx) - (s*dy) + px
+    np.multiply(c, dx, out=x)
+    x -= s*dy
+    x += px
+    # y = (s*dx) + (c*dy) + py
+    np.multiply(s, dx, out=y)
+    y += c*dy
+    y += py
+    return verts
+
+def _spike_geometry(records, dtype=np.float64):
+    """Build (and rotate) every spike triangle for a list of spike records in one batched step
+    All the vertex maths is done in place, in the given dtype
+    Returns the (n,3,2) vertices and (n,3) face colours"""
+    counts = np.array([len(r.unit) for r in records], dtype=int)
+    n = counts.sum()
+    if n == 0:
+        return np.empty((0,3,2), dtype=dtype), np.empty((0,3), dtype=dtype)
+    unit = np.concatenate([r.unit for r in records], dtype=dtype)
+    jitter = np.concatenate([r.rnd[:4*len(r.unit)].reshape(4,-1) for r in records], axis=1, dtype=dtype)
+    jitter -= 0.5
+
+    # Per-branch values, repeated for each spike
+    def per_spike(values):
+        return np.repeat(np.array(values, dtype=dtype), counts)
+    x1 = per_spike([r.x1 for r in records])
+    width = per_spike([r.width for r in records])
+    spike_jitter = per_spike([r.spikes.spike_jitter for r in records])
+    spike_width = per_spike([r.spikes.spike_width for r in records])
+
+    # Base mid-points of all the spikes: written straight into the tips (v3), which are then moved in place
+    verts = np.empty((n,3,2), dtype=dtype)
+    posx, posy = verts[:,2,0], verts[:,2,1]
+    np.multiply(unit[:,0], width, out=posx)
+    posx += x1-(width/2)
+    np.multiply(unit[:,1], per_spike([r.length for r in records]), out=posy)
+    posy += per_spike([r.y1 for r in records])
+    del unit
+
+    # Jitter them for some randomness, and calculate the verticies of the triangles
+    half = spike_width*width/2
+    jitter *= spike_jitter
+    np.subtract(posx, (1+jitter[0])*half, out=verts[:,0,0])
+    np.add(posx, (1+jitter[1])*half, out=verts[:,1,0])
+    verts[:,0,1] = posy
+    verts[:,1,1] = posy
+    del half
+
+    # Tip of spikes
+    edge_distance = (((verts[:,0,0]+verts[:,1,0])/2)-x1) / (width/2) # what proportion are they to the edge (with +/- sign)
+    angles = per_spike([r.spikes.spike_angle_scale for r in records])
+    angles *= edge_distance # radians, away from the branch direction
+    del edge_distance
+    reach = per_spike([r.spikes.spike_reach for r in records])
+    reach *= width
+    posx += reach*np.sin(angles)
+    posx += jitter[2]*spike_width*width
+    posy += reach*np.cos(angles)
+    posy += jitter[3]*spike_width*width*2 #y should jitter a bit more than x!
+    del reach, angles, jitter
+
+    # Rotate each set of spikes with its branch
+    rotation = np.array([r.rotation for r in records])
+    verts = _rotate(verts, per_spike([r.pivot_x for r in records]), per_spike([r.pivot_y for r in records]),
+                    np.repeat(np.cos(rotation).astype(dtype), counts), np.repeat(np.sin(rotation).astype(dtype), counts))
+
+    # Colours
+    cols = np.concatenate([r.rnd[4*len(r.unit):].reshape(-1,3) for r in records], dtype=dtype)
+    cols -= 0.5
+    cols *= per_spike([r.spikes.spike_colour_jitter for r in records])[:,None]
+    cols += np.repeat(np.array([r.colour for r in records], dtype=dtype), counts, axis=0)
+    return verts, np.clip(cols, 0, 1, out=cols)
+
+def geometry_size(geometry):
+    """Size of the larger side of a tree's bounding box (of its rects & spikes), in data units"""
+    points = np.concatenate([geometry.rects.reshape(-1,2), geometry.spikes.reshape(-1,2)]).astype(float)
+    return np.ptp(points, axis=0).max() if len(points) else 0.0
+
+def drawn_size(geometry, ax):
+    """Size of the larger side of a tree's bounding box, in pixels, as drawn on an axis (with its current limits)"""
+    points = np.concatenate([geometry.rects.reshape(-1,2), geometry.spikes.reshape(-1,2)]).astype(float)
+    if not len(points):
+        return 0.0
+    return np.abs(np.diff(ax.transData.transform([points.min(axis=0), points.max(axis=0)]), axis=0)).max()
+
+def _draw_culled(geometry, cull):
+    """Draw a tree's geometry on the current axis, culled at the size it is drawn if cull is True"""
+    if cull:
+        import matplotlib.pyplot as plt
+        geometry = cull_geometry(geometry, drawn_size(geometry, plt.gca()))
+    draw_geometry(geometry)
+
+def cull_geometry(geometry, pixels=None, margin=1, chunk=16):
+    """Remove the spikes & rectangular segments which are completely hidden behind primitives drawn after them
+    (e.g. brown back spikes under the green & yellow leaves, or the rectangular segments under the spikes)
+    Works back through the drawing order with a coverage raster of CULL_POINTS_PER_PIXEL points per pixel: a
+    primitive is dropped if every point in & around it (within `margin` points, for its edge line) is covered by the
+    primitives after it. pixels is the drawn size of the tree (see drawn_size), so no uncovered gap between the later
+    primitives is big enough to show at that size; by default it is the tree's size in data units (one pixel per data
+    unit, as scenes are drawn by compositing.render_layer)
+    The raster grows with the square of the size, so trees drawn bigger than MAX_CULL_PIXELS are returned as they
+    are. Culling takes longer than drawing the tree, and removes a few percent of its primitives, so it only
+    pays off when the culled geometry is drawn more than once at the same size
+    Returns a new TreeGeometry (the segments are kept; only the rects & spikes are culled)"""
+    n_rects = len(geometry.rects)
+    if n_rects + len(geometry.spikes) == 0:
+        return geometry
+    if pixels is None:
+        pixels = geometry_size(geometry)
+    if pixels > MAX_CULL_PIXELS:
+        return geometry
+    # All primitives as quads (triangles repeat their tip), in drawing order: by zorder, rects before spikes
+    quads = np.concatenate([geometry.rects.astype(float), geometry.spikes[:,[0,1,2,2]].astype(float)])
+    zorders = np.concatenate([geometry.rect_zorders, geometry.spike_zorders]).astype(float)
+    order = np.argsort(2*zorders + (np.arange(len(quads)) >= n_rects), kind='stable')
+    quads = quads[order]
+
+    # Coverage raster (in units of the point spacing), and the bounding box of points around each primitive
+    lo = quads.reshape(-1,2).min(axis=0)
+    spacing = (quads.reshape(-1,2).max(axis=0) - lo).max() / max(pixels*CULL_POINTS_PER_PIXEL, 1)
+    if spacing == 0:
+        return geometry
+    quads = (quads - lo) / spacing
+    shape = np.floor(quads.reshape(-1,2).max(axis=0)).astype(int)[::-1] + 1
+    covered = np.zeros(shape, dtype=bool)
+    p0 = np.maximum(np.ceil(quads.min(axis=1)).astype(int) - margin, 0)
+    p1 = np.minimum(np.floor(quads.max(axis=1)).astype(int) + margin, shape[::-1]-1)
+    # Each edge is a half-plane (a*x <= b on every row y), with its normal pointing out of the polygon
+    edges = np.roll(quads, -1, axis=1) - quads
+    orientation = np.sign(np.sum(quads[:,:,0]*edges[:,:,1] - quads[:,:,1]*edges[:,:,0], axis=1))
+    a = orientation[:,None] * edges[:,:,1]
+    b0 = orientation[:,None] * (quads[:,:,0]*edges[:,:,1] - quads[:,:,1]*edges[:,:,0])
+    b_slope = orientation[:,None] * edges[:,:,0]
+    grow = np.abs(edges).sum(axis=2)
+
+    def spans(sl, rows, distance):
+        """First & last point (x) on each row which is within the distance of each primitive (empty if first > last)"""
+        b = b0[sl,None,:] + b_slope[sl,None,:]*rows[:,:,None] + distance*grow[sl,None,:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bound = b / a[sl,None,:]
+        first = np.where(a[sl,None,:] < 0, bound, -np.inf).max(axis=2)
+        last = np.where(a[sl,None,:] > 0, bound, np.inf).min(axis=2)
+        last[((a[sl,None,:] == 0) & (b < 0)).any(axis=2)] = -1
+        first = np.maximum(np.ceil(np.clip(first, -1, shape[1])), p0[sl,0,None])
+        last = np.minimum(np.floor(np.clip(last, -1, shape[1])), p1[sl,0,None])
+        return first.astype(int), last.astype(int)
+
+    keep = np.ones(len(quads), dtype=bool)
+    for start in reversed(range(0, len(quads), chunk)):
+        sl = slice(start, start+chunk)
+        # The chunk's window of the raster, with the number of uncovered points before each point on its rows
+        y0, x0 = p0[sl,1].min(), p0[sl,0].min()
+        y1, x1 = p1[sl,1].max(), p1[sl,0].max()
+        window = covered[y0:y1+1, x0:x1+1]
+        uncovered = np.zeros((y1-y0+1, x1-x0+2), dtype=int)
+        np.cumsum(~window, axis=1, out=uncovered[:,1:])
+        rows = p0[sl,1,None] + np.arange((p1[sl,1] - p0[sl,1]).max() + 1)
+        in_rows = rows <= p1[sl,1,None]
+        r = np.minimum(rows, y1) - y0
+
+        # Hidden if no point near the primitive is uncovered
+        first, last = spans(sl, rows, margin)
+        n = uncovered[r, np.clip(last-x0+1, 0, x1-x0+1)] - uncovered[r, np.clip(first-x0, 0, x1-x0+1)]
+        hidden = ((n <= 0) | (last < first) | ~in_rows).all(axis=1)
+        keep[sl] = ~hidden
+
+        # Add the points inside each visible primitive to the coverage (as +1/-1 at the ends of each span)
+        first, last = spans(sl, rows, 0)
+        fill = in_rows & (last >= first) & ~hidden[:,None] & (orientation[sl,None] != 0)
+        diff = np.zeros((y1-y0+1, x1-x0+2), dtype=int)
+        np.add.at(diff, (r[fill], first[fill]-x0), 1)
+        np.add.at(diff, (r[fill], last[fill]-x0+1), -1)
+        window |= np.cumsum(diff, axis=1)[:,:-1] > 0
+
+    keep_order = np.empty_like(keep)
+    keep_order[order] = keep
+    keep_rects, keep_spikes = keep_order[:n_rects], keep_order[n_rects:]
+    return geometry._replace(
+        rects=geometry.rects[keep_rects],
+        rect_zorders=geometry.rect_zorders[keep_rects],
+        spikes=geometry.spikes[keep_spikes],
+        spike_colours=geometry.spike_colours[keep_spikes],
+        spike_layers=geometry.spike_layers[keep_spikes],
+        spike_zorders=geometry.spike_zorders[keep_spikes])
+
+def _edge_styles(spike_params, layers):
+    """Edge colour(s) & width(s) of spikes: a single value if all layers share it, otherwise one per spike"""
+    from matplotlib.colors import to_rgba_array
+    edge_colours = to_rgba_array([p.spike_edge_colour for p in spike_params])
+    edge_widths = np.array([p.spike_edge_width for p in spike_params], dtype=float)
+    used = np.unique(layers)
+    if len(used) and (edge_colours[used] == edge_colours[used[0]]).all():
+        edge_colours = edge_colours[used[0]]
+    else:
+        edge_colours = edge_colours[layers]
+    if len(used) and (edge_widths[used] == edge_widths[used[0]]).all():
+        edge_widths = edge_widths[used[0]]
+    else:
+        edge_widths = edge_widths[layers]
+    return edge_colours, edge_widths
+
+def draw_geometry(geometry, ax=None):
+    """Draw the geometry of a Joshua Tree (see generate_joshua_tree) on the given (or current) axis
+    Adds one collection per zorder: the rectangular segments (if any), and then the spikes"""
+    from matplotlib.collections import PolyCollection
+    if ax is None:
+        # pyplot (& its global state) is only needed when drawing on the current axis
+        import matplotlib.pyplot as plt
+        ax = plt.gca()
+    for z in np.unique(np.concatenate([geometry.rect_zorders, geometry.spike_zorders])):
+        i0, i1 = np.searchsorted(geometry.rect_zorders, [z, z+1])
+        if i1 > i0:
+            ax.add_collection(PolyCollection(geometry.rects[i0:i1],
+                                             zorder=z,
+                                             facecolors=geometry.rect_colour,
+                                             edgecolors=geometry.rect_colour))
+        i0, i1 = np.searchsorted(geometry.spike_zorders, [z, z+1])
+        if i1 > i0:
+            edge_colours, edge_widths = _edge_styles(geometry.spike_params, geometry.spike_layers[i0:i1])
+            face_colours = geometry.spike_colours[i0:i1]
+            if face_colours.dtype == np.uint8:
+                face_colours = face_colours / np.float32(255)
+            ax.add_collection(PolyCollection(geometry.spikes[i0:i1],
+                                             zorder=z,
+                                             facecolors=face_colours,
+                                             edgecolors=edge_colours,
+                                             linewidths=edge_widths))
+
+def fit_axis(ax, bbox_data, w, h, pad=0.05):
+    """Set the limits of an axis filling a (w x h) pixel canvas, so the data bounding box fits with equal aspect
+    Returns the bounding box in pixel coordinates [x0, y0, x1, y1] (origin at the top-left of the image)"""
+    x0, y0, x1, y1 = bbox_data
+    cx, cy = (x0+x1)/2, (y0+y1)/2
+    scale = max((x1-x0)/w, (y1-y0)/h) * (1+2*pad) # data units per pixel
+    xlim = (cx - scale*w/2, cx + scale*w/2)
+    ylim = (cy - scale*h/2, cy + scale*h/2)
+    ax.set_xlim(*xlim)
+    ax.set_ylim(*ylim)
+    return [
+        round((x0-xlim[0])/scale, 2),
+        round((ylim[1]-y1)/scale, 2),
+        round((x1-xlim[0])/scale, 2),
+        round((ylim[1]-y0)/scale, 2)
+    ]
 
 def draw_spikes(
                 x1,
@@ -224,63 +630,33 @@ def draw_spikes(
                 spike_max_angle=40,
                 spike_zorder=5,
                 darken=None):
-    """Draws some spikes (which can be the live green leaves pointing up, or dead brown leaves pointin down which cover the branches)"""
-    # Rect mid positions
-    rx, ry = x1-(width/2), y1
-    
-    # Determine the initial base mid-points of all the spikes
-    # Random
-    if spike_layout == 'random':
-        n = int((width*length) / (0.5*spike_width*width*spike_length*width) * spike_density_rnd)
-        pos = np.random.random((n,2)) * np.array([width, length]) + np.array([rx,ry])
-    # Regular
-    elif spike_layout == 'regular':
-        nx = int(np.ceil((1 / spike_width) * spike_density_x))
-        ny = int(np.ceil((1 / (spike_length*width/length)) * spike_density_y))
-        n = nx*ny
-        posx, posy = np.meshgrid(np.linspace(rx,rx+width,nx), np.linspace(ry,ry+length,ny))
-        pos = np.vstack([posx.reshape(-1), posy.reshape(-1)]).T
-        
-    # Jitter them for some randomness
-    jitter_x1 = 1+((np.random.random(n)-0.5)*spike_jitter)
-    jitter_x2 = 1+((np.random.random(n)-0.5)*spike_jitter)
-
-    # Calculate the verticies of the triangles
-    v1 = pos - np.array([(jitter_x1*spike_width*width/2),np.zeros(n)]).T
-    v2 = pos + np.array([(jitter_x2*spike_width*width/2),np.zeros(n)]).T
-    v3 = pos
-    
-    # Tip of spikes
-    edge_distance = (((v1[:,0]+v2[:,0])/2)-x1) / (width/2) # what proportion are they to the edge (with +/- sign)
-    angles = spike_direction*spike_max_angle*edge_distance
-    v3[:,0] += spike_direction * spike_length*width * np.cos(np.radians(90-angles))
-    v3[:,1] += spike_direction * spike_length*width * np.sin(np.radians(90-angles))
-    
-    # Jitter the tip
-    jitter_x3 = ((np.random.random(n)-0.5)*spike_jitter)*spike_width*width
-    jitter_y3 = ((np.random.random(n)-0.5)*spike_jitter)*spike_width*width*2 #y should jitter a bit more than x!
-    v3[:,0] += jitter_x3
-    v3[:,1] += jitter_y3
-    
-    # Generate the colours and patches
+    """Draws some spikes (which can be the live green leaves pointing up, or dead brown leaves pointin down which cover the branches)
+    Returns the spikes as a (unrotated) collection, which is not yet added to an axis"""
+    spikes = config.compile_spikes({
+        'spike_direction': spike_direction,
+        'spike_colour': spike_colour,
+        'spike_edge_colour': spike_edge_colour,
+        'spike_edge_width': spike_edge_width,
+        'spike_colour_jitter': spike_colour_jitter,
+        'spike_width': spike_width,
+        'spike_length': spike_length,
+        'spike_jitter': spike_jitter,
+        'spike_layout': spike_layout,
+        'spike_density_x': spike_density_x,
+        'spike_density_y': spike_density_y,
+        'spike_density_rnd': spike_density_rnd,
+        'spike_max_angle': spike_max_angle
+    })
     if darken is not None:
         spike_colour = colours.darken(spike_colour, darken)
-    cols = colours.mod_col(spike_colour, spike_colour_jitter, n)
-    spikes_list = []
-    for i in range(n):
-        spikes_list.append(plt.Polygon([v1[i,:],v2[i,:],v3[i,:]]))
-    
-    # Sort them so they draw in the correct order (from the base upwards)
-    sort_idx = np.argsort(v1[:,1])[::-1*spike_direction]
-    spikes_list = list(np.array(spikes_list)[sort_idx])
-    spikes_collection = PatchCollection(spikes_list,
-                                        zorder=spike_zorder,
-                                        facecolors=cols,
-                                        edgecolor=spike_edge_colour,
-                                        lw=spike_edge_width)
-    
-    # Return
-    return spikes_collection
+    from matplotlib.collections import PolyCollection
+    style = _TreeStyle(None, False, (True,), (spikes,), (spike_colour,))
+    verts, cols = _spike_geometry([_spike_record(0, spike_zorder, x1, y1, 0.0, x1, y1, width, length, style)])
+    return PolyCollection(verts,
+                          zorder=spike_zorder,
+                          facecolors=cols,
+                          edgecolors=spikes.spike_edge_colour,
+                          linewidths=spikes.spike_edge_width)
 
 def draw_dead_tree(
                     x1=0,
@@ -301,6 +677,9 @@ def draw_dead_tree(
     """Draws a simple dead tree at using matplotlib Rectangles
     Default tree begins at (0,0) and has sensible defaults for a (1600 x 900) canvas
     Everything is fully customisable by setting the keyword arguments"""
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Rectangle
     if seed is not None:
         np.random.seed(seed)
     if depth:
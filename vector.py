@@ -0,0 +1,358 @@
+"""
+vector.py
+Vector (SVG & PDF) export of Joshua Tree scenes, written straight from the tree geometry (see tree.TreeGeometry),
+which is much more compact than saving a matplotlib figure (one path, with its full style, per spike):
+    * coordinates are quantised, and written as integers relative to each tree (& in SVG, to the previous point)
+    * colours are quantised, and each (fill, edge) style is written once: as an SVG class, or a PDF colour change
+    * consecutive primitives with the same style are merged into one compound path (if they don't overlap, so the
+      drawing order is kept), and primitives hidden by an identical later one are dropped
+    * repeated trees (the same shape & colours at another position) are written once & reused (<use>, or a PDF form)
+The sky & terrains are drawn first, then the trees in the order given (each tree in its own drawing order)
+
+Usage:
+    python vector.py forest.svg --trees 40 --seed 0
+    python vector.py forest.pdf --trees 40 --seed 0
+"""
+
+# Standard imports
+import argparse
+import collections
+import itertools
+import sys
+import zlib
+import numpy as np
+
+# Self imports
+import colours
+import landscape
+import tree
+
+# A terrain to export: (n,2) points along its top edge (as returned by landscape.midpoint_displacement), filled down
+# to the bottom of the exported region
+Terrain = collections.namedtuple('Terrain', ['points', 'colour'])
+
+# Size of one data unit: one pixel at 100 dpi (as rendered by compositing.render_layer & service.py)
+PT_PER_UNIT = 0.72
+
+def _rgb(colour):
+    """RGB (0-1 floats) of a colour given as a sequence, or as a matplotlib colour string (e.g. 'k')"""
+    if isinstance(colour, str):
+        from matplotlib.colors import to_rgb
+        return np.array(to_rgb(colour))
+    return np.asarray(colour, dtype=float)[:3]
+
+def _quantise_colours(cols, bits):
+    """Quantise (n,3) colours (0-1 floats, or uint8) to the given bits per channel, as (n,3) uint8"""
+    cols = np.asarray(cols)
+    if cols.dtype == np.uint8:
+        cols = cols / 255
+    levels = 2**bits - 1
+    return np.rint(np.rint(np.clip(cols, 0, 1) * levels) * 255 / levels).astype(np.uint8)
+
+def _tree_chunks(geometry):
+    """The primitives of a tree in drawing order (by zorder: rects, then spikes, as in tree.draw_geometry)
+    Yields (polygons (n,k,2), fill colours (n,3), edge colours (n,3), edge widths in points (n,))"""
+    edge_colours = np.array([_rgb(p.spike_edge_colour) for p in geometry.spike_params])
+    edge_widths = np.array([p.spike_edge_width for p in geometry.spike_params], dtype=float)
+    for z in np.unique(np.concatenate([geometry.rect_zorders, geometry.spike_zorders])):
+        i0, i1 = np.searchsorted(geometry.rect_zorders, [z, z+1])
+        if i1 > i0:
+            # Rects are filled & edged in their colour, with matplotlib's default (1pt) line width
+            rect_colours = np.repeat(_rgb(geometry.rect_colour)[None], i1-i0, axis=0)
+            yield geometry.rects[i0:i1], rect_colours, rect_colours, np.ones(i1-i0)
+        i0, i1 = np.searchsorted(geometry.spike_zorders, [z, z+1])
+        if i1 > i0:
+            layers = geometry.spike_layers[i0:i1]
+            yield geometry.spikes[i0:i1], geometry.spike_colours[i0:i1], edge_colours[layers], edge_widths[layers]
+
+def _merge(prims, max_subpaths=256):
+    """Merge consecutive primitives with the same style into compound paths, as long as they don't overlap (including
+    their edge lines): a compound path is filled, then stroked, as a whole, so overlaps would change the result
+    Returns a list of (style id, [polygons])"""
+    paths, boxes = [], []
+    for style, poly, width in prims:
+        lo, hi = poly.min(axis=0) - width/2, poly.max(axis=0) + width/2
+        box = (lo[0], lo[1], hi[0], hi[1])
+        if paths and paths[-1][0] == style and len(boxes) < max_subpaths and \
+           not any(box[0] <= b[2] and b[0] <= box[2] and box[1] <= b[3] and b[1] <= box[3] for b in boxes):
+            paths[-1][1].append(poly)
+            boxes.append(box)
+        else:
+            paths.append((style, [poly]))
+            boxes = [box]
+    return paths
+
+class _Document:
+    """State shared by everything in one export: the exported region, the quantisation & the table of styles"""
+    def __init__(self, view, precision, colour_bits, flip):
+        self.x0, self.y0, self.w, self.h = view
+        self.scale = 10**precision
+        self.colour_bits = colour_bits
+        self.flip = flip # -1 for SVG (y down), 1 for PDF (y up)
+        self.styles = {}
+
+    def style(self, fill, edge=None, width=0):
+        """Id of a (fill, edge, width) style; edge is None for filled-only shapes"""
+        return self.styles.setdefault((fill, edge, width), len(self.styles))
+
+    def position(self, x, y):
+        """Quantised position of a data point, in the document's coordinates"""
+        x = int(np.rint((x - self.x0) * self.scale))
+        y = int(np.rint(((self.y0 + self.h - y) if self.flip < 0 else (y - self.y0)) * self.scale))
+        return x, y
+
+    def drawing(self, chunks, ox, oy):
+        """Quantise primitives relative to the point (ox, oy), drop the degenerate & hidden duplicate ones, and merge
+        the rest into paths (see _merge)"""
+        prims = []
+        for polys, fills, edges, widths in chunks:
+            q = np.empty(polys.shape, dtype=np.int64)
+            q[:,:,0] = np.rint((polys[:,:,0] - ox) * self.scale)
+            q[:,:,1] = np.rint(self.flip * (polys[:,:,1] - oy) * self.scale)
+            fills = _quantise_colours(fills, self.colour_bits).tolist()
+            edges = _quantise_colours(edges, self.colour_bits).tolist()
+            widths = np.round(widths / PT_PER_UNIT * self.scale, 2).tolist()
+            degenerate = (q == q[:,:1]).all(axis=(1,2))
+            prims.extend((self.style(tuple(f), tuple(e), w), p, w) for f, e, w, p, d in zip(fills, edges, widths, q, degenerate) if not d)
+        # A primitive covered by an identical later one (same shape & style) is hidden, whatever is drawn in between
+        last = {}
+        for i, (style, poly, _) in enumerate(prims):
+            last[(style, poly.tobytes())] = i
+        return _merge([prims[i] for i in sorted(last.values())])
+
+    def trees(self, trees, cull_dpi=None):
+        """Quantised drawing (list of paths) of each tree, relative to its origin, culled at its size at cull_dpi
+        Returns a list of (drawing id, paths, ox, oy), where identical drawings share their id"""
+        drawings, ids = [], {}
+        for geometry in trees:
+            if cull_dpi is not None:
+                geometry = tree.cull_geometry(geometry, tree.geometry_size(geometry) * PT_PER_UNIT/72 * cull_dpi)
+            points = geometry.segments.reshape(-1,2) if len(geometry.segments) else geometry.spikes.reshape(-1,2)
+            # The origin is on the quantisation grid, so a reused drawing is placed exactly where it would be drawn
+            ox, oy = np.rint(points[0] * self.scale) / self.scale if len(points) else (0.0, 0.0)
+            paths = self.drawing(_tree_chunks(geometry), ox, oy)
+            key = tuple((style, b''.join(p.tobytes() for p in polys)) for style, polys in paths)
+            drawings.append((ids.setdefault(key, len(ids)), paths, ox, oy))
+        return drawings
+
+def _view(trees, terrains, w, h):
+    """The (x0, y0, w, h) region to export: the (w x h) scene, or else the bounding box of all the trees & terrains"""
+    if w is not None and h is not None:
+        return 0.0, 0.0, float(w), float(h)
+    points = [g.spikes.reshape(-1,2) for g in trees] + [g.rects.reshape(-1,2) for g in trees] + [np.asarray(t.points) for t in terrains]
+    points = np.concatenate([p.astype(float) for p in points if len(p)])
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    pad = 0.02 * (hi - lo).max()
+    return lo[0]-pad, lo[1]-pad, hi[0]-lo[0]+2*pad, hi[1]-lo[1]+2*pad
+
+def _terrain_polygon(terrain, y0):
+    """Closed polygon of a terrain, filled down to y0"""
+    points = np.asarray(terrain.points, dtype=float)
+    return np.concatenate([points, [[points[-1,0], y0], [points[0,0], y0]]])
+
+def _sky_colours(cmap, n=17):
+    """n colours of the sky gradient from top to bottom (approximating the bicubic interpolation of landscape.draw_sky)"""
+    t = np.clip((np.linspace(0, 1, n) - 0.25) / 0.5, 0, 1)
+    return _quantise_colours([cmap(v)[:3] for v in t*t*(3 - 2*t)], 8)
+
+def _reused(drawings):
+    """Ids of the drawings used more than once"""
+    counts = collections.Counter(i for i, _, _, _ in drawings)
+    return {i for i, n in counts.items() if n > 1}
+
+# SVG
+
+def _hex(rgb):
+    """Shortest hex form of a uint8 colour"""
+    h = '{:02x}{:02x}{:02x}'.format(*rgb)
+    return '#' + (h[0::2] if h[0::2] == h[1::2] else h)
+
+def _svg_d(polys):
+    """SVG path data of (quantised) polygons, with relative moves & lines"""
+    parts = []
+    prev = (0, 0)
+    for i, p in enumerate(polys):
+        # After closing a subpath, the current point is its start, so each move is relative to the previous start
+        start = (int(p[0,0]), int(p[0,1]))
+        lines = ' '.join(map(str, np.diff(p, axis=0).reshape(-1).tolist()))
+        parts.append('{}{} {}l{}z'.format('m' if i else 'M', start[0]-prev[0], start[1]-prev[1], lines))
+        prev = start
+    return ''.join(parts).replace(' -', '-')
+
+def _svg_paths(paths):
+    """SVG elements of some paths: consecutive paths with the same style are grouped, so the class is written once"""
+    out = []
+    for style, group in itertools.groupby(paths, key=lambda p: p[0]):
+        ds = [_svg_d(polys) for _, polys in group]
+        if len(ds) == 1:
+            out.append('<path class="s{}" d="{}"/>'.format(style, ds[0]))
+        else:
+            out.append('<g class="s{}">{}</g>'.format(style, ''.join('<path d="{}"/>'.format(d) for d in ds)))
+    return '\n'.join(out)
+
+def svg_document(trees, w=None, h=None, terrains=(), sky=None, precision=1, colour_bits=4, cull_dpi=None):
+    """SVG of some trees (tree.TreeGeometry) in front of terrains (Terrain) & a sky (a colourmap, as for landscape.draw_sky)
+    The exported region is the (w x h) scene, or the bounding box of the trees & terrains if not given
+    Coordinates are rounded to `precision` decimal places (of data units), and colours to `colour_bits` per channel
+    cull_dpi drops the spikes which are hidden when the export is rasterised at that dpi (see tree.cull_geometry); a
+    vector export is usually shown at any size (e.g. in print), where the gaps between the later spikes can show, so
+    by default nothing is culled
+    Returns the SVG as a string"""
+    trees = list(trees)
+    doc = _Document(_view(trees, terrains, w, h), precision, colour_bits, flip=-1)
+    width, height = int(round(doc.w*doc.scale)), int(round(doc.h*doc.scale))
+    defs, body = [], []
+    if sky is not None:
+        stops = ''.join('<stop offset="{:g}" stop-color="{}"/>'.format(t, _hex(c)) for t, c in
+                        zip(np.linspace(0, 1, 17).round(4), _sky_colours(sky).tolist()))
+        defs.append('<linearGradient id="sky" x1="0" y1="0" x2="0" y2="1">{}</linearGradient>'.format(stops))
+        body.append('<rect width="{}" height="{}" fill="url(#sky)"/>'.format(width, height))
+    for terrain in terrains:
+        style = doc.style(tuple(_quantise_colours([_rgb(terrain.colour)], 8)[0].tolist()))
+        polygon = np.array([doc.position(x, y) for x, y in _terrain_polygon(terrain, doc.y0)])
+        body.append('<path class="s{}" d="{}"/>'.format(style, _svg_d([polygon])))
+    drawings = doc.trees(trees, cull_dpi)
+    reused, defined = _reused(drawings), set()
+    for i, paths, ox, oy in drawings:
+        x, y = doc.position(ox, oy)
+        if i not in reused:
+            body.append('<g transform="translate({} {})">\n{}\n</g>'.format(x, y, _svg_paths(paths)))
+            continue
+        if i not in defined:
+            defs.append('<g id="t{}">\n{}\n</g>'.format(i, _svg_paths(paths)))
+            defined.add(i)
+        body.append('<use href="#t{0}" xlink:href="#t{0}" x="{1}" y="{2}"/>'.format(i, x, y))
+    css = []
+    for (fill, edge, stroke_width), i in doc.styles.items():
+        rule = 'fill:{}'.format(_hex(fill))
+        if edge is not None:
+            rule += ';stroke:{};stroke-width:{:g}'.format(_hex(edge), stroke_width)
+        css.append('.s{}{{{}}}'.format(i, rule))
+    return '\n'.join([
+        ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+         'width="{:g}pt" height="{:g}pt" viewBox="0 0 {} {}">').format(round(doc.w*PT_PER_UNIT, 2), round(doc.h*PT_PER_UNIT, 2), width, height),
+        '<style>path{{stroke-linejoin:round}}{}</style>'.format(''.join(css)),
+        '<defs>{}</defs>'.format('\n'.join(defs)),
+        '\n'.join(body),
+        '</svg>\n'])
+
+# PDF
+
+def _pdf_paths(paths, styles):
+    """PDF content (path & colour operators) of some paths; colours & widths are only set when they change"""
+    ops = []
+    state = {}
+    for style, polys in paths:
+        fill, edge, width = styles[style]
+        changes = [('rg', fill), ('RG', edge), ('w', width)] if edge is not None else [('rg', fill)]
+        for op, value in changes:
+            if state.get(op) != value:
+                state[op] = value
+                ops.append('{:g} w'.format(value) if op == 'w' else '{:.3g} {:.3g} {:.3g} {}'.format(*[c/255 for c in value], op))
+        for p in polys:
+            ops.append('{} {} m {} h'.format(p[0,0], p[0,1], ' '.join('{} {} l'.format(x, y) for x, y in p[1:].tolist())))
+        ops.append('B' if edge is not None else 'f')
+    return '\n'.join(ops)
+
+def _pdf_bbox(paths, styles):
+    points = np.concatenate([np.concatenate(polys) for _, polys in paths])
+    pad = max(styles[s][2] for s, _ in paths)
+    return '[{} {} {} {}]'.format(*(points.min(axis=0) - pad).tolist(), *(points.max(axis=0) + pad).tolist())
+
+def pdf_document(trees, w=None, h=None, terrains=(), sky=None, precision=1, colour_bits=4, cull_dpi=None):
+    """PDF (one page) of some trees in front of terrains & a sky: see svg_document for the arguments
+    Returns the PDF as bytes"""
+    trees = list(trees)
+    doc = _Document(_view(trees, terrains, w, h), precision, colour_bits, flip=1)
+    page_w, page_h = round(doc.w*PT_PER_UNIT, 2), round(doc.h*PT_PER_UNIT, 2)
+    objects = [None, None, None] # catalog, pages & page are written last
+    def add(obj):
+        objects.append(obj)
+        return len(objects)
+    def stream(entries, data):
+        data = zlib.compress(data if isinstance(data, bytes) else data.encode())
+        return '<< {} /Filter /FlateDecode /Length {} >>\nstream\n'.format(entries, len(data)).encode() + data + b'\nendstream'
+
+    content, resources = ['1 j'], {'XObject': [], 'Shading': []}
+    if sky is not None:
+        function = add(stream('/FunctionType 0 /Domain [0 1] /Range [0 1 0 1 0 1] /Size [17] /BitsPerSample 8', _sky_colours(sky).tobytes()))
+        shading = add('<< /ShadingType 2 /ColorSpace /DeviceRGB /Coords [0 {:g} 0 0] /Function {} 0 R /Extend [true true] >>'.format(page_h, function).encode())
+        resources['Shading'].append('/Sh0 {} 0 R'.format(shading))
+        content.append('q 0 0 {:g} {:g} re W n /Sh0 sh Q'.format(page_w, page_h))
+    # Everything else is in quantised units
+    content.append('{0:g} 0 0 {0:g} 0 0 cm'.format(PT_PER_UNIT / doc.scale))
+    for terrain in terrains:
+        style = doc.style(tuple(_quantise_colours([_rgb(terrain.colour)], 8)[0].tolist()))
+        polygon = np.array([doc.position(x, y) for x, y in _terrain_polygon(terrain, doc.y0)])
+        content.append(_pdf_paths([(style, [polygon])], {v: k for k, v in doc.styles.items()}))
+    drawings = doc.trees(trees, cull_dpi)
+    styles = {v: k for k, v in doc.styles.items()}
+    reused, forms = _reused(drawings), {}
+    for i, paths, ox, oy in drawings:
+        if not paths:
+            continue
+        x, y = doc.position(ox, oy)
+        if i not in reused:
+            content.append('q 1 0 0 1 {} {} cm\n{}\nQ'.format(x, y, _pdf_paths(paths, styles)))
+            continue
+        if i not in forms:
+            forms[i] = add(stream('/Type /XObject /Subtype /Form /BBox {}'.format(_pdf_bbox(paths, styles)), _pdf_paths(paths, styles)))
+            resources['XObject'].append('/T{} {} 0 R'.format(i, forms[i]))
+        content.append('q 1 0 0 1 {} {} cm /T{} Do Q'.format(x, y, i))
+    contents = add(stream('', '\n'.join(content)))
+    resources = ' '.join('/{} << {} >>'.format(k, ' '.join(v)) for k, v in resources.items() if v)
+    objects[0] = b'<< /Type /Catalog /Pages 2 0 R >>'
+    objects[1] = b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>'
+    objects[2] = '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {:g} {:g}] /Contents {} 0 R /Resources << {} >> >>'.format(
+        page_w, page_h, contents, resources).encode()
+
+    out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for n, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += '{} 0 obj\n'.format(n).encode() + obj + b'\nendobj\n'
+    xref = len(out)
+    out += 'xref\n0 {}\n0000000000 65535 f \n'.format(len(objects)+1).encode()
+    out += b''.join('{:010d} 00000 n \n'.format(o).encode() for o in offsets)
+    out += 'trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(len(objects)+1, xref).encode()
+    return bytes(out)
+
+def save(path, trees, **kwargs):
+    """Export some trees (& terrains, sky: see svg_document) to an .svg or .pdf file"""
+    if path.lower().endswith('.pdf'):
+        with open(path, 'wb') as f:
+            f.write(pdf_document(trees, **kwargs))
+    else:
+        with open(path, 'w') as f:
+            f.write(svg_document(trees, **kwargs))
+
+def forest(n=40, seed=0, w=1600, h=900):
+    """Geometry of an example forest scene: n random trees along a terrain ridge
+    Returns (trees, terrain)"""
+    np.random.seed(seed)
+    terrain = Terrain(landscape.midpoint_displacement([0, 200], [w, 200], 1.1, 100, 10), '0.1')
+    trees = []
+    for i, tree_x in enumerate(np.linspace(0, w, n)):
+        tree_y = terrain.points[np.argmin(np.abs(terrain.points[:,0]-tree_x)),1] - 50
+        trees.append(tree.generate_random_joshua_tree(tree_x, tree_y, length=100, darken=0.8, seed=seed+i))
+    return trees, terrain
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export an example forest scene as SVG or PDF")
+    parser.add_argument('out', help="Output file (.svg or .pdf)")
+    parser.add_argument('--trees', type=int, default=40, help="Number of trees")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', type=int, nargs=2, default=[1600, 900], metavar=('W', 'H'))
+    parser.add_argument('--sky', default='crimson_tide', help="Sky colourmap (one of colours.cmaps)")
+    parser.add_argument('--precision', type=int, default=1, help="Decimal places of the coordinates")
+    parser.add_argument('--colour-bits', type=int, default=4, help="Bits per colour channel")
+    parser.add_argument('--cull-dpi', type=float, default=None, help="Drop the spikes hidden behind others when rasterised at this dpi (not for print)")
+    args = parser.parse_args(argv)
+    w, h = args.size
+    trees, terrain = forest(args.trees, args.seed, w, h)
+    save(args.out, trees, w=w, h=h, terrains=[terrain], sky=colours.cmaps[args.sky],
+         precision=args.precision, colour_bits=args.colour_bits, cull_dpi=args.cull_dpi)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))